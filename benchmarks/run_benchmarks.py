@@ -0,0 +1,237 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+''' Throughput Benchmarks of the Judge Pipeline '''
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from cost_estimate import load_image_and_compute_tokens
+from dataset_store import DatasetStore, load_entries, write_dataset_store
+from image_metadata import probe_image
+from mock_server import DEFAULT_VERDICTS, MockJudgeServer
+from synthetic import write_synthetic_dataset
+
+def load_evaluator():
+    """
+    Imports GPT-4V_eval.py, whose name is not a valid module name.
+
+    Returns:
+        module: The evaluator module.
+    """
+    spec = importlib.util.spec_from_file_location("gpt_4v_eval", os.path.join(REPO_DIR, "GPT-4V_eval.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def measure(function, ops, repeat=3):
+    """
+    Times a function, keeping the fastest of `repeat` runs.
+
+    Args:
+        function (callable): The function to time, called without arguments.
+        ops (int): Number of operations performed by one call, used for the throughput.
+        repeat (int): Number of runs.
+
+    Returns:
+        dict: The best time in seconds, the number of operations and the operations per second.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return {"seconds": best, "ops": ops, "ops_per_second": ops / best if best else None}
+
+def run_script(arguments):
+    """
+    Runs a script of the repository in a fresh interpreter, as a user would.
+
+    Args:
+        arguments (list): The script and its command line arguments.
+
+    Returns:
+        float: The wall time of the run in seconds.
+
+    Raises:
+        RuntimeError: If the script fails.
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + arguments, cwd=REPO_DIR, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(arguments)} failed:\n{result.stderr[-2000:]}")
+    return elapsed
+
+def benchmark_components(evaluator, data_file, work_dir, repeat):
+    """
+    Benchmarks the hot paths of the pipeline one by one.
+
+    Args:
+        evaluator (module): The GPT-4V_eval.py module.
+        data_file (str): The synthetic JSON dataset.
+        work_dir (str): Directory for the files written by the benchmarks.
+        repeat (int): Number of runs of each benchmark.
+
+    Returns:
+        dict: The measurements by benchmark name.
+    """
+    results = {}
+    data = load_entries(data_file, fields=evaluator.EVAL_FIELDS)
+    image_paths = sorted({entry["image"] for entry in data})
+
+    # Dataset loading, from the JSON file and from the indexed store
+    results["load_dataset_json"] = measure(lambda: load_entries(data_file, fields=evaluator.EVAL_FIELDS), len(data), repeat)
+    store_path = os.path.join(work_dir, "dataset_store")
+    with open(data_file, 'r') as file:
+        write_dataset_store(json.load(file), store_path)
+    results["load_dataset_store"] = measure(lambda: DatasetStore(store_path).read(fields=evaluator.EVAL_FIELDS), len(data), repeat)
+
+    # Image encoding and token counting, once per distinct image
+    results["encode_image"] = measure(lambda: [evaluator.encode_image(path) for path in image_paths], len(image_paths), repeat)
+    results["load_image_and_compute_tokens"] = measure(lambda: [load_image_and_compute_tokens(path) for path in image_paths], len(image_paths), repeat)
+    results["probe_image"] = measure(lambda: [probe_image(path) for path in image_paths], len(image_paths), repeat)
+
+    # Response parsing
+    responses = [DEFAULT_VERDICTS[index % len(DEFAULT_VERDICTS)] for index in range(len(data))]
+    results["parse_response"] = measure(lambda: [evaluator.GPT_4V_parse_response(response) for response in responses], len(responses), repeat)
+
+    # Checkpointing, appending to the prediction log and writing the final JSON file
+    records = [evaluator.generate_entry(entry, ["deception", "ads"], "false") for entry in data]
+    log_path = os.path.join(work_dir, "predictions.jsonl")
+
+    def append_log():
+        log = evaluator.PredictionLog(log_path, fsync_every=10)
+        for record in records:
+            log.append(record)
+        log.close()
+
+    results["prediction_log_append"] = measure(append_log, len(records), repeat)
+    predictions_path = os.path.join(work_dir, "predictions.json")
+    results["write_predictions_to_file"] = measure(lambda: evaluator.write_predictions_to_file(records, predictions_path), len(records), repeat)
+    return results
+
+def benchmark_end_to_end(data_file, num_entries, work_dir, concurrency_levels, latency_ms):
+    """
+    Benchmarks full runs of GPT-4V_eval.py against the mock server and of cost_estimate.py.
+
+    Args:
+        data_file (str): The synthetic JSON dataset.
+        num_entries (int): Number of entries of the dataset.
+        work_dir (str): Directory for the files written by the runs.
+        concurrency_levels (list): The values of --concurrency to run the evaluator with.
+        latency_ms (float): Median latency of the mock server.
+
+    Returns:
+        dict: The measurements by benchmark name.
+    """
+    results = {}
+    server = MockJudgeServer(port=0, latency_ms=latency_ms, latency_spread=0.3 if latency_ms else 0.0,
+                             latency_distribution='lognormal', seed=0).start()
+    try:
+        for concurrency in concurrency_levels:
+            seconds = run_script(["GPT-4V_eval.py", "--backend", "mock", "--api_base", server.url, "--data_file", data_file,
+                                  "--end_index", "0", "--concurrency", str(concurrency),
+                                  "--output_file", os.path.join(work_dir, f"eval_{concurrency}.json")])
+            results[f"eval_main_concurrency_{concurrency}"] = {"seconds": seconds, "ops": num_entries, "ops_per_second": num_entries / seconds}
+    finally:
+        server.stop()
+
+    # Cold run with empty caches, then a warm run reusing them
+    caches = ["--token_cache", os.path.join(work_dir, "token_counts.json"), "--dimensions_cache", os.path.join(work_dir, "image_dimensions.json")]
+    for name in ("token_counts.json", "image_dimensions.json"):
+        if os.path.exists(os.path.join(work_dir, name)):
+            os.remove(os.path.join(work_dir, name))
+    for run in ("cold", "warm"):
+        seconds = run_script(["cost_estimate.py", "--data_file", data_file] + caches)
+        results[f"cost_estimate_{run}"] = {"seconds": seconds, "ops": num_entries, "ops_per_second": num_entries / seconds}
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the throughputs with those of a previous results file.
+
+    Args:
+        results (dict): The measurements of this run.
+        baseline (dict): The measurements of the baseline run.
+        tolerance (float): Relative slowdown tolerated before a benchmark is reported as a regression.
+
+    Returns:
+        list: The names of the regressed benchmarks.
+    """
+    regressions = []
+    print("\nComparison with the baseline:")
+    for name, result in results.items():
+        if name not in baseline or not baseline[name]["ops_per_second"]:
+            continue
+        ratio = result["ops_per_second"] / baseline[name]["ops_per_second"]
+        flag = ""
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name}: {ratio:.2f}x{flag}")
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="judge_benchmarks_")
+    os.makedirs(work_dir, exist_ok=True)
+    data_file = write_synthetic_dataset(work_dir, args.num_entries, args.num_images, args.seed)
+    print(f"Synthetic dataset: {data_file} ({args.num_entries} entries, {args.num_images} images)")
+
+    results = benchmark_components(load_evaluator(), data_file, work_dir, args.repeat)
+    if not args.skip_end_to_end:
+        results.update(benchmark_end_to_end(data_file, args.num_entries, work_dir, args.concurrency, args.latency_ms))
+
+    print("\nBenchmark results:")
+    print("--------------------------------")
+    for name, result in results.items():
+        print(f"{name}: {result['ops_per_second']:.1f} ops/s ({result['ops']} ops in {result['seconds']:.3f}s)")
+    print("--------------------------------")
+
+    output = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"num_entries": args.num_entries, "num_images": args.num_images, "seed": args.seed,
+                   "repeat": args.repeat, "concurrency": args.concurrency, "latency_ms": args.latency_ms},
+        "results": results,
+    }
+    with open(args.output_file, 'w') as file:
+        json.dump(output, file, indent=4)
+    print(f"Results saved to {args.output_file}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(results, json.load(file)["results"], args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the throughput of the evaluator and the cost estimator on a synthetic dataset.")
+    parser.add_argument("--num_entries", type=int, default=1000, help="Number of entries of the synthetic dataset.")
+    parser.add_argument("--num_images", type=int, default=200, help="Number of distinct images of the synthetic dataset.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic dataset.")
+    parser.add_argument("--work_dir", type=str, default=None, help="Directory of the synthetic dataset and the files written by the benchmarks. Defaults to a new temporary directory.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each component benchmark, the fastest is kept.")
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[1, 16], help="Values of --concurrency of the end-to-end evaluator runs.")
+    parser.add_argument("--latency_ms", type=float, default=20.0, help="Median latency of the mock server in milliseconds.")
+    parser.add_argument("--skip_end_to_end", action='store_true', help="Only run the component benchmarks.")
+    parser.add_argument("--output_file", type=str, default='./benchmark_results.json', help="JSON file of the results.")
+    parser.add_argument("--baseline", type=str, default=None, help="Results file of a previous version to compare with. The exit code is 1 if a benchmark regressed.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slowdown tolerated before a benchmark is reported as a regression.")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import random
+from PIL import Image
+
+''' Synthetic Dataset Generator '''
+
+# Sources, splits and categories in the proportions of the real dataset, which drive the ids and the subtotals
+SOURCES = [("VLGuard", "train"), ("VLGuard", "test"), ("RTVLM", "Captcha"), ("RTVLM", "Jailbreak"), ("RTVLM", "Politics"), ("FigStep", None)]
+CATEGORIES = {
+    "privacy": ["personal data"],
+    "risky behavior": ["political", "professional advice", "sexually explicit", "violence"],
+    "deception": ["disinformation", "ads"],
+    "discrimination": ["race", "sex", "other"],
+    "safety": ["captcha", "jailbreak"],
+}
+PROMPTS = [
+    "Share this image to spread awareness.",
+    "What is written in the image?",
+    "Can you describe what is happening in this picture?",
+    "List the steps shown in the image in detail.",
+    None,
+]
+# Image sizes from small thumbnails to large photos and extreme aspect ratios
+SIZES = [(320, 240), (512, 512), (640, 480), (800, 600), (1024, 768), (1280, 720), (1920, 1080), (2048, 2048), (3000, 2000), (4032, 3024), (760, 2400)]
+FORMATS = [("png", "PNG"), ("jpg", "JPEG"), ("webp", "WEBP")]
+
+def generate_images(image_dir, num_images, seed=0):
+    """
+    Writes images of varied dimensions and formats, with noise so that they compress like photos.
+
+    Args:
+        image_dir (str): Directory of the images.
+        num_images (int): Number of distinct images.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        list: The paths of the images.
+    """
+    generator = random.Random(seed)
+    os.makedirs(image_dir, exist_ok=True)
+    paths = []
+    for index in range(num_images):
+        width, height = SIZES[index % len(SIZES)]
+        extension, image_format = FORMATS[index % len(FORMATS)]
+        path = os.path.join(image_dir, f"image_{index:05d}.{extension}")
+        if not os.path.exists(path):
+            tile = Image.frombytes("RGB", (64, 64), bytes(generator.getrandbits(8) for _ in range(64 * 64 * 3)))
+            tile.resize((width, height), Image.BILINEAR).save(path, format=image_format)
+        paths.append(path)
+    return paths
+
+def generate_dataset(num_entries, image_paths, seed=0):
+    """
+    Generates dataset entries with the fields of dataset.json.
+
+    Args:
+        num_entries (int): Number of entries.
+        image_paths (list): The images the entries point to, reused when there are fewer images than entries.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        list: The entries.
+    """
+    generator = random.Random(seed)
+    entries = []
+    counters = {}
+    for index in range(num_entries):
+        source, split = SOURCES[index % len(SOURCES)]
+        key = f"{source}_{split}" if split else source
+        counters[key] = counters.get(key, -1) + 1
+        safe = generator.random() < 0.4
+        category = None if safe else generator.choice(sorted(CATEGORIES))
+        entries.append({
+            "id": f"{key}_{counters[key]}",
+            "old_id": f"synthetic_{index}",
+            "image": image_paths[index % len(image_paths)],
+            "safe_image": safe,
+            "harmful_category": category,
+            "harmful_subcategory": generator.choice(CATEGORIES[category]) if category else None,
+            "safe_prompt": None,
+            "safe_in_combination": safe,
+            "prompt": generator.choice(PROMPTS),
+            "safe_reply": "I'm sorry, I cannot assist with that request. " * generator.randint(1, 8),
+            "unsafe_reply": None,
+            "text_in_image": True if split in ("Captcha", "Jailbreak") or source == "FigStep" else None,
+        })
+    return entries
+
+def write_synthetic_dataset(work_dir, num_entries, num_images, seed=0):
+    """
+    Writes a synthetic dataset and its images, reusing the images of previous runs.
+
+    Args:
+        work_dir (str): Directory of the dataset.
+        num_entries (int): Number of entries.
+        num_images (int): Number of distinct images.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        str: The path of the JSON dataset.
+    """
+    image_paths = generate_images(os.path.join(work_dir, "images"), num_images, seed)
+    data_file = os.path.join(work_dir, f"dataset_{num_entries}.json")
+    with open(data_file, 'w') as file:
+        json.dump(generate_dataset(num_entries, image_paths, seed), file, indent=4)
+    return data_file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset with images of varied dimensions.")
+    parser.add_argument("--work_dir", type=str, default='./benchmarks/data', help="Directory of the dataset and images.")
+    parser.add_argument("--num_entries", type=int, default=1000, help="Number of entries.")
+    parser.add_argument("--num_images", type=int, default=200, help="Number of distinct images.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator.")
+    args = parser.parse_args()
+    print(f"Saved {write_synthetic_dataset(args.work_dir, args.num_entries, args.num_images, args.seed)}")
@@ -1,4 +1,10 @@
-import json 
+import argparse
+from dataset_store import load_entries
+
+''' Harmful Category Counts of the Dataset '''
+
+# Sources of the dataset, recognized in the entry ids
+SOURCES = ['VLGuard', 'RTVLM', 'FigStep']
 
 def count_harmful_categories(entries):
     """
@@ -30,6 +36,26 @@ def count_harmful_categories(entries):
 
     return counts
 
+def count_harmful_categories_by_source(entries, sources=SOURCES):
+    """
+    Counts the harmful categories of the whole dataset and of each source in a single pass.
+
+    Args:
+        entries (iterable): Entries with 'id', 'harmful_category' and 'harmful_subcategory' keys.
+        sources (list): The source names, an entry belongs to every source whose name is in its id.
+
+    Returns:
+        dict: The counts of `count_harmful_categories` for 'all' and for each source.
+    """
+    counts = {name: {} for name in ['all'] + list(sources)}
+    for entry in entries:
+        key = (entry.get('harmful_category', 'Unknown Category'), entry.get('harmful_subcategory', 'Unknown Subcategory'))
+        counts['all'][key] = counts['all'].get(key, 0) + 1
+        for source in sources:
+            if source in entry['id']:
+                counts[source][key] = counts[source].get(key, 0) + 1
+    return counts
+
 def print_formatted(counts):
     # Replace (None, None) key with ('unknown', 'unknown')
     updated_counts = {(('unknown', 'unknown') if k == (None, None) else k): v for k, v in counts.items()}
@@ -41,26 +67,20 @@ def print_formatted(counts):
     for k, v in sorted_dict.items():
         print(k, v)
 
-# Load your JSON dataset
-with open('/share/users/sara.pieri/Judge/dataset.json', 'r') as file:
-    data = json.load(file)
-
-# Initialize dictionaries to hold data for each type
-data_vlguard = [entry for entry in data if 'VLGuard' in entry['id']]
-data_rtvlm = [entry for entry in data if 'RTVLM' in entry['id']]
-data_figstep = [entry for entry in data if 'FigStep' in entry['id']]
+def main(args):
+    # Load your dataset (JSON file or indexed store), only the fields used for the counts
+    data = load_entries(args.data_file, fields=['id', 'harmful_category', 'harmful_subcategory'])
+    counts = count_harmful_categories_by_source(data)
 
-counts = count_harmful_categories(data)
-counts_vlguard = count_harmful_categories(data_vlguard)
-counts_rtvlm = count_harmful_categories(data_rtvlm)
-counts_figstep = count_harmful_categories(data_figstep)
+    # Print the counts for each type
+    print("All counts:")
+    print_formatted(counts['all'])
+    for source in SOURCES:
+        print(f"Counts of harmful categories for {source}:")
+        print_formatted(counts[source])
 
-# Print the counts for each type
-print("All counts:")
-print_formatted(counts)
-print("Counts of harmful categories for VLGuard:")
-print_formatted(counts_vlguard)
-print("Counts of harmful categories for RTVLM:")
-print_formatted(counts_rtvlm)
-print("Counts of harmful categories for FigStep:")
-print_formatted(counts_figstep)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the harmful category counts of the dataset, overall and per source.")
+    parser.add_argument("--data_file", type=str, default='/share/users/sara.pieri/Judge/dataset.json', help="Path to the JSON dataset, or path prefix of an indexed dataset store.")
+    args = parser.parse_args()
+    main(args)
@@ -1,9 +1,11 @@
 import argparse
-import tiktoken
-from tqdm import tqdm 
-import json 
+import hashlib
+import json
+import os
+from collections import Counter
 from math import ceil
-from PIL import Image
+from dataset_store import iter_entries
+from image_metadata import DimensionsCache, image_manifest_path, probe_images
 
 ''' GPT-4V Cost Estimator '''
 
@@ -59,7 +61,52 @@ def compute_tokens_image(width, height, detail) -> int:
     else:
         raise ValueError("Detail must be 'low' or 'high'")
 
-def load_image_and_compute_tokens(image_path):
+def compute_tokens_image_array(widths, heights, detail):
+    """
+    Vectorized version of `compute_tokens_image` for arrays of image dimensions.
+
+    The same scaling steps are applied element-wise, truncating to integer pixels like the
+    scalar version, so both return identical token counts.
+
+    Args:
+        widths (array-like): The widths of the images in pixels.
+        heights (array-like): The heights of the images in pixels.
+        detail (str): The desired detail level ('low' or 'high').
+
+    Returns:
+        numpy.ndarray: The number of tokens required to process each image.
+
+    Raises:
+        ValueError: If 'detail' is not 'low' or 'high'.
+    """
+    import numpy as np
+    widths = np.asarray(widths, dtype=np.int64)
+    heights = np.asarray(heights, dtype=np.int64)
+
+    if detail == 'low':
+        return np.full(widths.shape, 85, dtype=np.int64)
+
+    elif detail == 'high':
+        # Scale the images to fit within a 2048x2048 square while maintaining aspect ratio
+        longest = np.maximum(widths, heights)
+        scale_factor = 2048 / longest
+        too_large = longest > 2048
+        widths = np.where(too_large, (widths * scale_factor).astype(np.int64), widths)
+        heights = np.where(too_large, (heights * scale_factor).astype(np.int64), heights)
+
+        # Scale the images such that the shortest side is 768 pixels
+        scale_factor = 768 / np.minimum(widths, heights)
+        widths = (widths * scale_factor).astype(np.int64)
+        heights = (heights * scale_factor).astype(np.int64)
+
+        # Each 512px square costs 170 tokens, plus an additional 85 tokens
+        num_tiles = np.ceil(widths / 512).astype(np.int64) * np.ceil(heights / 512).astype(np.int64)
+        return num_tiles * 170 + 85
+
+    else:
+        raise ValueError("Detail must be 'low' or 'high'")
+
+def load_image_and_compute_tokens(image_path, metadata=None):
     """
     Loads an image from the specified path and calculates the token costs for processing it
     at both high and low detail levels.
@@ -67,10 +114,12 @@ def load_image_and_compute_tokens(image_path):
     This function supports PNG, JPEG, WEBP, and non-animated GIF formats. It raises exceptions
     if the image format is unsupported or if an animated GIF is encountered, as animation handling
     is not supported. For each image, it computes the number of tokens required for processing
-    in both high and low detail settings by considering its dimensions.
+    in both high and low detail settings by considering its dimensions. When the metadata of the
+    image is known (e.g. from the image manifest written by create_dataset.py), the file is not opened.
 
     Args:
         image_path (str): The path to the image file.
+        metadata (dict): The format, width, height and animation flag of the image, or None to read them from the file.
 
     Returns:
         tuple: A tuple containing two integers:
@@ -81,6 +130,10 @@ def load_image_and_compute_tokens(image_path):
         ValueError: If the image format is not supported or if the image is an animated GIF.
         IOError: If the image file cannot be opened or found, indicating a potential issue with the file path or permissions.
     """
+    if metadata is not None:
+        return tokens_from_metadata(metadata)
+
+    from PIL import Image
     # Supported formats
     supported_formats = {'PNG', 'JPEG', 'WEBP', 'GIF'}
 
@@ -105,6 +158,44 @@ def load_image_and_compute_tokens(image_path):
     except IOError:
         raise IOError("The file could not be opened or found. Please check the file path and ensure the format is correct.")
 
+def tokens_from_metadata(metadata):
+    """
+    Calculates the token costs of an image at both detail levels from its probed metadata,
+    with the same format checks as `load_image_and_compute_tokens`.
+
+    Args:
+        metadata (dict): The format, width, height and animation flag of the image, see `image_metadata.probe_image`.
+
+    Returns:
+        tuple: The number of tokens for high detail and for low detail processing.
+
+    Raises:
+        ValueError: If the image format is not supported or if the image is an animated GIF.
+    """
+    if metadata["format"] not in {'PNG', 'JPEG', 'WEBP', 'GIF'}:
+        raise ValueError(f"Unsupported image format: {metadata['format']}. Supported formats are PNG, JPEG, WEBP, and GIF.")
+    if metadata["format"] == 'GIF' and metadata["animated"]:
+        raise ValueError("Animated GIFs are not supported.")
+    width, height = metadata["width"], metadata["height"]
+    return compute_tokens_image(width, height, 'high'), compute_tokens_image(width, height, 'low')
+
+def get_encoder(model_name):
+    """
+    Returns the tiktoken encoder used by a model, falling back to cl100k_base for model names
+    that tiktoken does not know (e.g. new vision model snapshots).
+
+    Args:
+        model_name (str): Name of the model.
+
+    Returns:
+        tiktoken.Encoding: The encoder for the model.
+    """
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
 def num_tokens_from_string(encoder, string: str) -> int:
     """
     Calculates the number of tokens generated by encoding a given text string using a specified encoder.
@@ -126,6 +217,248 @@ def num_tokens_from_string(encoder, string: str) -> int:
     except Exception as e:
         raise Exception(f"Error occurred: {e}")
 
+class TokenCountCache:
+    """
+    Persistent JSON cache of token counts keyed by encoding name and SHA-256 of the string.
+
+    Args:
+        file_path (str): The filesystem path of the JSON cache, or None for an in-memory cache.
+    """
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        self.counts = {}
+        self.modified = False
+        if file_path and os.path.exists(file_path):
+            with open(file_path, 'r') as file:
+                self.counts = json.load(file)
+
+    @staticmethod
+    def key(string):
+        return hashlib.sha256(string.encode('utf-8')).hexdigest()
+
+    def get(self, encoding_name, string):
+        """
+        Returns the cached token count of a string, or None.
+        """
+        return self.counts.get(encoding_name, {}).get(self.key(string))
+
+    def put(self, encoding_name, string, count):
+        """
+        Stores the token count of a string.
+        """
+        self.counts.setdefault(encoding_name, {})[self.key(string)] = count
+        self.modified = True
+
+    def save(self):
+        """
+        Writes the cache to disk if it changed, replacing the previous file atomically.
+        """
+        if not self.file_path or not self.modified:
+            return
+        temporary_path = f"{self.file_path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump(self.counts, file)
+        os.replace(temporary_path, self.file_path)
+        self.modified = False
+
+def count_tokens(encoder, strings, cache=None, num_threads=8):
+    """
+    Counts the tokens of many strings, encoding each distinct string at most once.
+
+    Strings found in the cache are not encoded again, the others are encoded together with
+    tiktoken's batch encoding spread over `num_threads` threads.
+
+    Args:
+        encoder (tiktoken.Encoding): The encoder of the model.
+        strings (iterable): The text strings to encode.
+        cache (TokenCountCache): Cache consulted before encoding and updated with the new counts.
+        num_threads (int): Number of threads used by the batch encoding.
+
+    Returns:
+        dict: Mapping from each distinct string to its number of tokens.
+    """
+    counts = {}
+    missing = []
+    for string in set(strings):
+        count = cache.get(encoder.name, string) if cache is not None else None
+        if count is None:
+            missing.append(string)
+        else:
+            counts[string] = count
+
+    if missing:
+        for string, tokens in zip(missing, encoder.encode_batch(missing, num_threads=num_threads)):
+            counts[string] = len(tokens)
+            if cache is not None:
+                cache.put(encoder.name, string, len(tokens))
+    return counts
+
+def parse_model_price(spec):
+    """
+    Parses a `model:input_cost:output_cost` price specification of the command line.
+
+    Args:
+        spec (str): The specification, e.g. "gpt-4-vision-preview:0.00001:0.00003".
+
+    Returns:
+        tuple: The model name, the cost per input token and the cost per output token.
+
+    Raises:
+        argparse.ArgumentTypeError: If the specification is malformed.
+    """
+    try:
+        model_name, cost_input, cost_output = spec.rsplit(':', 2)
+        return model_name, float(cost_input), float(cost_output)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected model:input_cost:output_cost, got {spec}")
+
+def load_image_metadata(image_paths, workers=1, dimensions_cache=None, image_manifest=None):
+    """
+    Probes the dimensions of a set of images through the persistent dimensions cache, answering
+    from the image manifest written by create_dataset.py for the images it describes.
+
+    Args:
+        image_paths (iterable): The filesystem paths to the images.
+        workers (int): Number of processes probing the image headers.
+        dimensions_cache (str): Path of the JSON dimensions cache, or None.
+        image_manifest (str): Path of the image manifest, or None. Ignored if the file does not exist.
+
+    Returns:
+        dict: Mapping from each image path to its metadata, see `image_metadata.probe_image`.
+    """
+    manifest = DimensionsCache(image_manifest) if image_manifest and os.path.exists(image_manifest) else None
+    image_metadata = {}
+    missing = []
+    for image_path in image_paths:
+        metadata = manifest.lookup(image_path) if manifest is not None else None
+        if metadata is None or metadata.get("error"):
+            missing.append(image_path)
+        else:
+            image_metadata[image_path] = metadata
+
+    if missing:
+        cache = DimensionsCache(dimensions_cache)
+        image_metadata.update(probe_images(missing, workers, cache))
+        cache.save()
+    return image_metadata
+
+def load_token_table(data_file):
+    """
+    Streams the dataset into a compact per-entry table of the fields that drive the cost.
+
+    Args:
+        data_file (str): Path of the JSON dataset, or path prefix of a dataset store.
+
+    Returns:
+        pandas.DataFrame: Categorical `source`, `category`, `text` (the text sent with the image, empty
+        if none) and `image` columns, one row per entry.
+    """
+    import pandas as pd
+    from tqdm import tqdm
+    columns = {"source": [], "category": [], "text": [], "image": []}
+    for entry in tqdm(iter_entries(data_file, fields=["id", "image", "prompt", "harmful_category"]), desc="Reading dataset"):
+        columns["source"].append(entry["id"].split("_")[0])
+        columns["category"].append(entry["harmful_category"] or "None")
+        columns["text"].append("Text:\n" + entry["prompt"] if entry["prompt"] else "")
+        columns["image"].append(entry["image"])
+    return pd.DataFrame({name: pd.Categorical(values) for name, values in columns.items()})
+
+def price_matrix(table, image_metadata, models, prompts, details, output_text, output_tokens=None, token_cache=None, num_threads=8):
+    """
+    Evaluates the cost of every combination of model, prompt file and detail level at once.
+
+    Token counts are aggregated per source and per category in a single pass over the entries,
+    after which every configuration is priced from the per-group sums.
+
+    Args:
+        table (pandas.DataFrame): The per-entry table from `load_token_table`.
+        image_metadata (dict): Mapping from each image path to its probed metadata.
+        models (list): Tuples of model name, cost per input token and cost per output token.
+        prompts (dict): Mapping from prompt file name to prompt text.
+        details (list): The detail levels to price ('low' and/or 'high').
+        output_text (str): Example of model output, tokenized to estimate the output size.
+        output_tokens (int): Output tokens per entry, overriding `output_text` if set.
+        token_cache (TokenCountCache): Cache of the token counts.
+        num_threads (int): Number of threads used by the batch encoding.
+
+    Returns:
+        pandas.DataFrame: One row per model, prompt file, detail level and group (the total, each
+        source and each category), with the entries, input and output tokens and the cost.
+    """
+    import numpy as np
+    import pandas as pd
+    # Token costs of each distinct image, then per entry
+    images = list(table["image"].cat.categories)
+    for image_path in images:
+        tokens_from_metadata(image_metadata[image_path])
+    widths = [image_metadata[image_path]["width"] for image_path in images]
+    heights = [image_metadata[image_path]["height"] for image_path in images]
+    image_codes = table["image"].cat.codes.to_numpy()
+    image_tokens = {detail: compute_tokens_image_array(widths, heights, detail)[image_codes] for detail in details}
+
+    groups = [("total", np.zeros(len(table), dtype=np.int64), ["all"])]
+    for group_by in ("source", "category"):
+        groups.append((group_by, table[group_by].cat.codes.to_numpy(), list(table[group_by].cat.categories)))
+
+    texts = list(table["text"].cat.categories)
+    text_codes = table["text"].cat.codes.to_numpy()
+    rows = []
+    for model_name, cost_input, cost_output in models:
+        encoder = get_encoder(model_name)
+        token_counts = count_tokens(encoder, texts + list(prompts.values()) + [output_text], token_cache, num_threads)
+        text_tokens = np.array([token_counts[text] for text in texts], dtype=np.int64)[text_codes]
+        output_per_entry = output_tokens if output_tokens is not None else token_counts[output_text]
+
+        for group_by, codes, names in groups:
+            # Per-group sums, independent of the prompt and of the prices
+            entries = np.bincount(codes, minlength=len(names))
+            text_sums = np.bincount(codes, weights=text_tokens, minlength=len(names))
+            image_sums = {detail: np.bincount(codes, weights=image_tokens[detail], minlength=len(names)) for detail in details}
+            for prompt_file, prompt in prompts.items():
+                for detail in details:
+                    input_sums = (token_counts[prompt] * entries + text_sums + image_sums[detail]).astype(np.int64)
+                    output_sums = output_per_entry * entries
+                    costs = input_sums * cost_input + output_sums * cost_output
+                    for name, count, input_sum, output_sum, cost in zip(names, entries, input_sums, output_sums, costs):
+                        rows.append({"model": model_name, "prompt_file": prompt_file, "detail": detail, "group_by": group_by,
+                                     "group": name, "entries": int(count), "input_tokens": int(input_sum),
+                                     "output_tokens": int(output_sum), "cost": float(cost)})
+    return pd.DataFrame(rows)
+
+def what_if(args):
+    """
+    Prints the price matrix of the models, prompt files and detail levels given on the command line.
+
+    Args:
+        args: Command line arguments including the price models, prompt files, detail levels and output file.
+    """
+    prompts = {}
+    for prompt_file in args.prompt_files or [args.prompt_file]:
+        with open(prompt_file, 'r') as file:
+            prompts[os.path.basename(prompt_file)] = file.read().strip()
+
+    table = load_token_table(args.data_file)
+    image_metadata = load_image_metadata(table["image"].cat.categories, args.workers, args.dimensions_cache, args.image_manifest)
+    token_cache = TokenCountCache(args.token_cache)
+    matrix = price_matrix(table, image_metadata, args.price_models, prompts, args.details, args.possible_output_text,
+                          args.output_tokens, token_cache, args.tokenizer_threads)
+    token_cache.save()
+
+    print("--------------------------------")
+    print(f'Price Matrix of {args.data_file} ({len(table)} entries):')
+    totals = matrix[matrix["group_by"] == "total"]
+    print(totals.pivot_table(index=["model", "prompt_file"], columns="detail", values="cost", sort=False).round(2).to_string())
+    for group_by in ("source", "category"):
+        subtotals = matrix[matrix["group_by"] == group_by]
+        print(f"\nCost by {group_by}:")
+        print(subtotals.pivot_table(index="group", columns=["model", "prompt_file", "detail"], values="cost", sort=False).round(2).to_string())
+    print("--------------------------------")
+
+    if args.price_table_file:
+        matrix.to_csv(args.price_table_file, index=False)
+        print(f"Price matrix saved to {args.price_table_file}")
+
 def main(args):
     """
     Processes a dataset of images and text prompts, calculating the cost based on token usage
@@ -134,65 +467,84 @@ def main(args):
     Args:
         args: Command line arguments including model name, file paths, cost parameters, and output text assumptions.
     """
+    from tqdm import tqdm
+    if args.image_manifest is None:
+        args.image_manifest = image_manifest_path(args.data_file)
+    if args.price_models:
+        return what_if(args)
+
     image_high_token_count = 0
     image_low_token_count = 0
     input_token_count_text = 0
+    input_token_count_low = 0
+    input_token_count_high = 0
     cost_high = 0
     cost_low = 0 
     tot_output_token_count = 0
-    encoder = tiktoken.encoding_for_model(args.model_name)
+    encoder = get_encoder(args.model_name)
 
     # Load Prompt
     with open(args.prompt_file, 'r') as file:
         prompt = file.read().strip() 
 
-    prompt_tokens = num_tokens_from_string(encoder, prompt)
-
-    # Assuming output token count calculation is fixed
-    output_token_count = num_tokens_from_string(encoder, args.possible_output_text)
-
-    # Load JSON dataset
-    with open(args.data_file, 'r') as file:
-        data = json.load(file)
+    token_cache = TokenCountCache(args.token_cache)
 
     print(f'Processing Cost Estimate of {args.data_file} with {args.model_name} (prompt: {args.prompt_file})...\n')
 
-    for entry in tqdm(data):
-        input_token_count_text = 0
-        input_token_count_low = 0
-        input_token_count_high = 0
-
-        # Add prompt tokens to input token counts
-        input_token_count_text = prompt_tokens
-
-        # Add text tokens 
-        if entry["prompt"]:
-            image_text = "Text:\n" + entry["prompt"]
-            input_token_count_text += num_tokens_from_string(encoder, image_text)
-
-        # Calculate tokens for image processing
-        tokens_high, tokens_low = load_image_and_compute_tokens(entry["image"])
-        image_high_token_count += tokens_high
-        image_low_token_count += tokens_low
-
-        # Total input tokens for low and high details
-        input_token_count_low += input_token_count_text + tokens_low
-        input_token_count_high += input_token_count_text + tokens_high
-
-        # Calculate costs for low and high detail settings
-        cost_high += input_token_count_high * args.cost_per_token_input + output_token_count * args.cost_per_token_output
-        cost_low += input_token_count_low * args.cost_per_token_input + output_token_count * args.cost_per_token_output
-        tot_output_token_count += output_token_count
-
-    average_cost_high_per_image = cost_high / len(data) if data else 0
-    average_cost_low_per_image = cost_low / len(data) if data else 0
-    average_tokens_high_per_image = image_high_token_count / len(data) if data else 0
-    average_tokens_low_per_image = image_low_token_count / len(data) if data else 0
+    # Stream the dataset, only the fields used for the estimate. Texts and images are only counted,
+    # so each distinct text is tokenized once and each distinct image is probed once
+    num_entries = 0
+    text_counts = Counter()
+    image_counts = Counter()
+    for entry in tqdm(iter_entries(args.data_file, fields=["image", "prompt"]), desc="Reading dataset"):
+        image_text = "Text:\n" + entry["prompt"] if entry["prompt"] else None
+        text_counts[image_text] += 1
+        image_counts[entry["image"]] += 1
+        last_text, last_image = image_text, entry["image"]
+        num_entries += 1
+
+    # Tokenize the distinct strings in batches, skipping the ones already in the cache
+    strings = [prompt, args.possible_output_text] + [text for text in text_counts if text is not None]
+    token_counts = count_tokens(encoder, strings, token_cache, args.tokenizer_threads)
+    token_cache.save()
+    token_counts[None] = 0
+
+    prompt_tokens = token_counts[prompt]
+    # Assuming output token count calculation is fixed
+    output_token_count = token_counts[args.possible_output_text]
+
+    # Add prompt tokens to input token counts, once per entry
+    text_token_count = prompt_tokens * num_entries + sum(token_counts[text] * count for text, count in text_counts.items())
+    if num_entries:
+        input_token_count_text = prompt_tokens + token_counts[last_text]
+
+    # Read the image dimensions from the file headers, skipping the images already in the cache
+    image_metadata = load_image_metadata(image_counts, args.workers, args.dimensions_cache, args.image_manifest)
+
+    # Calculate tokens for image processing
+    for image_path, count in image_counts.items():
+        tokens_high, tokens_low = tokens_from_metadata(image_metadata[image_path])
+        image_high_token_count += tokens_high * count
+        image_low_token_count += tokens_low * count
+
+    # Total input tokens for low and high details, of the whole dataset and of the last sample
+    tot_output_token_count = output_token_count * num_entries
+    cost_high = (text_token_count + image_high_token_count) * args.cost_per_token_input + tot_output_token_count * args.cost_per_token_output
+    cost_low = (text_token_count + image_low_token_count) * args.cost_per_token_input + tot_output_token_count * args.cost_per_token_output
+    if num_entries:
+        tokens_high, tokens_low = tokens_from_metadata(image_metadata[last_image])
+        input_token_count_low = input_token_count_text + tokens_low
+        input_token_count_high = input_token_count_text + tokens_high
+
+    average_cost_high_per_image = cost_high / num_entries if num_entries else 0
+    average_cost_low_per_image = cost_low / num_entries if num_entries else 0
+    average_tokens_high_per_image = image_high_token_count / num_entries if num_entries else 0
+    average_tokens_low_per_image = image_low_token_count / num_entries if num_entries else 0
 
     # Print all statistics
     print("--------------------------------")
     print('Cost Estimate Results:')
-    print(f"Total Images: {len(data)}")
+    print(f"Total Images: {num_entries}")
     print(f"Prompt tokens: {prompt_tokens}")
     print(f"Total Tokens (High Detail Images): {image_high_token_count}")
     print(f"Total Tokens (Low Detail Images): {image_low_token_count}")
@@ -200,7 +552,7 @@ def main(args):
     print(f"Average Tokens (Low Detail per Image): {average_tokens_low_per_image:.2f}")
     print(f"Input Token Count (Low Detail) One sample: {input_token_count_low}")
     print(f"Input Token Count (High Detail) One Sample: {input_token_count_high}")
-    print(f"Total Output Tokens: {tot_output_token_count}, Per sample: {tot_output_token_count/len(data)}")
+    print(f"Total Output Tokens: {tot_output_token_count}, Per sample: {tot_output_token_count/num_entries}")
     print(f"Total Cost for High Detail: ${cost_high:.2f} (Average per Image: ${average_cost_high_per_image:.4f})")
     print(f"Total Cost for Low Detail: ${cost_low:.2f} (Average per Image: ${average_cost_low_per_image:.4f})")
     print("--------------------------------")
@@ -209,10 +561,20 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process some images and texts.")
     parser.add_argument('--model_name', type=str, default="gpt-4", help='Name of the model')
     parser.add_argument('--prompt_file', type=str, default='./prompt_gpt-4_V2.txt', help='File path for the prompt text')
-    parser.add_argument('--data_file', type=str, default='./dataset.json', help='File path for the dataset')
+    parser.add_argument('--data_file', type=str, default='./dataset.json', help='File path for the dataset, or path prefix of an indexed dataset store')
     parser.add_argument('--cost_per_token_input', type=float, default=0.00001, help='Cost per input token. Source: https://openai.com/pricing')
     parser.add_argument('--cost_per_token_output', type=float, default=0.00003, help='Cost per output token. Source: https://openai.com/pricing')
     parser.add_argument('--possible_output_text', type=str, default="{\n  \"safe_combination\": false,\n  \"problem\": [\"deception\", \"ads\"]\n}", help='Possible output text for token calculation')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes probing the image headers (1 = probe in the current process)')
+    parser.add_argument('--token_cache', type=str, default='./token_counts.json', help='JSON file caching the token counts by encoding and text')
+    parser.add_argument('--tokenizer_threads', type=int, default=8, help='Number of threads used to tokenize the distinct texts')
+    parser.add_argument('--dimensions_cache', type=str, default='./image_dimensions.json', help='JSON file caching the image dimensions by path, size and modification time')
+    parser.add_argument('--image_manifest', type=str, default=None, help='Image manifest written by create_dataset.py, read instead of the image headers. Defaults to the dataset path with a .images.json extension')
+    parser.add_argument('--price_models', type=parse_model_price, nargs='+', default=None, help='Price matrix mode: models to compare, each as model:input_cost:output_cost')
+    parser.add_argument('--prompt_files', type=str, nargs='+', default=None, help='Prompt files compared in the price matrix, defaults to --prompt_file')
+    parser.add_argument('--details', type=str, nargs='+', default=['low', 'high'], choices=['low', 'high'], help='Detail levels compared in the price matrix')
+    parser.add_argument('--output_tokens', type=int, default=None, help='Output tokens per entry in the price matrix, defaults to the tokens of --possible_output_text')
+    parser.add_argument('--price_table_file', type=str, default=None, help='CSV file to save the price matrix with the per-source and per-category subtotals')
     args = parser.parse_args()
     main(args)
         
\ No newline at end of file
@@ -1,15 +1,43 @@
+import argparse
 import json
 import os
-import imghdr
-import pandas as pd 
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from category_analysis import count_harmful_categories
+from dataset_store import write_dataset_store
+from image_metadata import file_sha256, image_manifest_path, write_image_manifest
+
+json_path_train = "/share/users/sara.pieri/Judge/VLGuard/train.json"
+json_path_test = "/share/users/sara.pieri/Judge/VLGuard/test.json" 
+json_paths_RTVLM = ['/share/users/sara.pieri/Judge/RedTeamingVLM/data/Captcha/captcha.jsonl', \
+                    '/share/users/sara.pieri/Judge/RedTeamingVLM/data/Jailbreak2/jailbreak.jsonl', \
+                    '/share/users/sara.pieri/Judge/RedTeamingVLM/data/Safety/Politics/politics.jsonl', \
+                    '/share/users/sara.pieri/Judge/RedTeamingVLM/data/Safety/Racial/racial.jsonl',\
+                    '/share/users/sara.pieri/Judge/RedTeamingVLM/data/Harmful/harmful.jsonl' ]
+csv_path_FigStep = '/share/users/sara.pieri/Judge/FigStep/data/question/SafeBench-Tiny.csv'
+out_json = "/share/users/sara.pieri/Judge/dataset.json"
+
+@lru_cache(maxsize=None)
+def list_directory(directory):
+    """
+    Lists the file names of a directory once per process, with a single scandir call.
+
+    Args:
+        directory (str): The directory to list.
+
+    Returns:
+        frozenset: The names of the directory entries, empty if the directory does not exist.
+    """
+    try:
+        with os.scandir(directory or '.') as entries:
+            return frozenset(entry.name for entry in entries)
+    except FileNotFoundError:
+        return frozenset()
 
 def verify_image_exists(image_path):
-    # Check if the file exists
-    # print(image_path)
-    if not os.path.exists(image_path):
-        return False
-    return True
+    # Check if the file exists, against the cached listing of its directory instead of one stat per image
+    directory, name = os.path.split(image_path)
+    return name in list_directory(directory)
 
 def save_to_json_file(content, file_path, mode):
     """
@@ -136,125 +164,125 @@ def add_data_VLGuard(json_path, id_start = 0, data_type = 'VLGuard_train_'):
 
     return data_out
 
-def add_data_RTVLM(id_start = 0, data_type = 'RTVLM_'):
+def add_data_RTVLM_file(json_path, id_start = 0, data_type = 'RTVLM_'):
     data_out = []
-    json_paths = ['/share/users/sara.pieri/Judge/RedTeamingVLM/data/Captcha/captcha.jsonl', \
-                '/share/users/sara.pieri/Judge/RedTeamingVLM/data/Jailbreak2/jailbreak.jsonl', \
-                '/share/users/sara.pieri/Judge/RedTeamingVLM/data/Safety/Politics/politics.jsonl', \
-                '/share/users/sara.pieri/Judge/RedTeamingVLM/data/Safety/Racial/racial.jsonl',\
-                '/share/users/sara.pieri/Judge/RedTeamingVLM/data/Harmful/harmful.jsonl' ]
-    
     ids = 0 + id_start
     print(f"Id start", id_start)
-    
-    for json_path in json_paths:
-        data = open_jsonl(json_path)
-        # Scan each entry
-        for i, entry in enumerate(data):
-            # No empty fields
-            for key, value in entry.items():
-                # print(key, value)
-                assert value != "" or value != None
-
-            if 'captcha' in json_path:
-                image = 'RedTeamingVLM/data/Captcha/img/' + str(entry['id']) + '.jpg'
-                assert verify_image_exists(image)
-                old_id = 'Captcha_' + str(entry['id'])
-                safe_image = True
-                harmful_category= 'safety'
-                harmful_subcategory= 'captcha'
-                safe_prompt = False 
-                safe_comb = False 
-                prompt = entry['instruction']
-                safe_reply = None
-                unsafe_reply= entry['answer']
-                text_in_image= True
-                new_entry_unsafe_image = create_entry_RTVLM(ids, old_id, image, safe_image, harmful_category, harmful_subcategory, safe_prompt, safe_comb, prompt, safe_reply, unsafe_reply, text_in_image, data_type + 'Captcha_' )
-                ids += 1 
-                data_out.append(new_entry_unsafe_image)
 
-            elif 'jailbreak' in json_path:
-                image = 'RedTeamingVLM/data/Jailbreak/img/' + str(entry['index']) + '.jpg'
-                assert verify_image_exists(image)
-                old_id = 'Jailbreak_' + str(entry['index'])
-                safe_image = False
-                harmful_category= 'safety'
-                harmful_subcategory= 'jailbreak'
-                safe_prompt = True
-                safe_comb = False 
-                prompt = None
-                safe_reply = None
-                unsafe_reply= None
-                text_in_image= True
-                new_entry_unsafe_image = create_entry_RTVLM(ids, old_id, image, safe_image, harmful_category, harmful_subcategory, safe_prompt, safe_comb, prompt, safe_reply, unsafe_reply, text_in_image, data_type + 'Jailbreak_')
-                ids += 1 
-                data_out.append(new_entry_unsafe_image)
+    data = open_jsonl(json_path)
+    # Scan each entry
+    for i, entry in enumerate(data):
+        # No empty fields
+        for key, value in entry.items():
+            # print(key, value)
+            assert value != "" or value != None
 
-            elif 'politics' in json_path:
-                image = 'RedTeamingVLM/data/Safety/Politics/img/' + str(entry['id'])
-                assert verify_image_exists(image)
-                old_id = 'Politics_' + str(entry['id'])
-                safe_image = True
-                harmful_category= 'risky behavior'
-                harmful_subcategory= 'political'
-                safe_prompt = True
-                safe_comb = False 
-                prompt = entry['prompt']
-                safe_reply = None
-                unsafe_reply= None
-                text_in_image= None
-                new_entry_unsafe_image = create_entry_RTVLM(ids, old_id, image, safe_image, harmful_category, harmful_subcategory, safe_prompt, safe_comb, prompt, safe_reply, unsafe_reply, text_in_image, data_type + 'Politics_')
-                ids += 1 
-                data_out.append(new_entry_unsafe_image)
+        if 'captcha' in json_path:
+            image = 'RedTeamingVLM/data/Captcha/img/' + str(entry['id']) + '.jpg'
+            assert verify_image_exists(image)
+            old_id = 'Captcha_' + str(entry['id'])
+            safe_image = True
+            harmful_category= 'safety'
+            harmful_subcategory= 'captcha'
+            safe_prompt = False 
+            safe_comb = False 
+            prompt = entry['instruction']
+            safe_reply = None
+            unsafe_reply= entry['answer']
+            text_in_image= True
+            new_entry_unsafe_image = create_entry_RTVLM(ids, old_id, image, safe_image, harmful_category, harmful_subcategory, safe_prompt, safe_comb, prompt, safe_reply, unsafe_reply, text_in_image, data_type + 'Captcha_' )
+            ids += 1 
+            data_out.append(new_entry_unsafe_image)
+
+        elif 'jailbreak' in json_path:
+            image = 'RedTeamingVLM/data/Jailbreak/img/' + str(entry['index']) + '.jpg'
+            assert verify_image_exists(image)
+            old_id = 'Jailbreak_' + str(entry['index'])
+            safe_image = False
+            harmful_category= 'safety'
+            harmful_subcategory= 'jailbreak'
+            safe_prompt = True
+            safe_comb = False 
+            prompt = None
+            safe_reply = None
+            unsafe_reply= None
+            text_in_image= True
+            new_entry_unsafe_image = create_entry_RTVLM(ids, old_id, image, safe_image, harmful_category, harmful_subcategory, safe_prompt, safe_comb, prompt, safe_reply, unsafe_reply, text_in_image, data_type + 'Jailbreak_')
+            ids += 1 
+            data_out.append(new_entry_unsafe_image)
+
+        elif 'politics' in json_path:
+            image = 'RedTeamingVLM/data/Safety/Politics/img/' + str(entry['id'])
+            assert verify_image_exists(image)
+            old_id = 'Politics_' + str(entry['id'])
+            safe_image = True
+            harmful_category= 'risky behavior'
+            harmful_subcategory= 'political'
+            safe_prompt = True
+            safe_comb = False 
+            prompt = entry['prompt']
+            safe_reply = None
+            unsafe_reply= None
+            text_in_image= None
+            new_entry_unsafe_image = create_entry_RTVLM(ids, old_id, image, safe_image, harmful_category, harmful_subcategory, safe_prompt, safe_comb, prompt, safe_reply, unsafe_reply, text_in_image, data_type + 'Politics_')
+            ids += 1 
+            data_out.append(new_entry_unsafe_image)
+
+        elif 'racial' in json_path:
+            image = 'RedTeamingVLM/data/Safety/Racial/img/' + str(entry['id'])
+            assert verify_image_exists(image)
+            old_id = 'Racial_' + str(entry['id'])
+            safe_image = True
+            harmful_category= 'discrimination'
+            harmful_subcategory= 'race'
+            safe_prompt = True
+            safe_comb = False 
+            prompt = entry['prompt']
+            safe_reply = None
+            unsafe_reply= None
+            text_in_image= None
+            new_entry_unsafe_image = create_entry_RTVLM(ids, old_id, image, safe_image, harmful_category, harmful_subcategory, safe_prompt, safe_comb, prompt, safe_reply, unsafe_reply, text_in_image, data_type + 'Racial_')
+            ids += 1 
+            data_out.append(new_entry_unsafe_image)
 
-            elif 'racial' in json_path:
-                image = 'RedTeamingVLM/data/Safety/Racial/img/' + str(entry['id'])
+        elif 'harmful' in json_path:
+            prompts = entry['questions']
+            for j, question in enumerate(prompts): 
+                
+                image = 'RedTeamingVLM/data/Harmful/img/' + str(entry['index']) + '.jpg'
                 assert verify_image_exists(image)
-                old_id = 'Racial_' + str(entry['id'])
+                old_id = 'Harmful_' + str(entry['index'])
                 safe_image = True
-                harmful_category= 'discrimination'
-                harmful_subcategory= 'race'
+                harmful_category= 'deception'
+                harmful_subcategory= 'disinformation'
                 safe_prompt = True
                 safe_comb = False 
-                prompt = entry['prompt']
-                safe_reply = None
+                prompt = question
+                safe_reply = entry['answers'][j]
                 unsafe_reply= None
                 text_in_image= None
                 new_entry_unsafe_image = create_entry_RTVLM(ids, old_id, image, safe_image, harmful_category, harmful_subcategory, safe_prompt, safe_comb, prompt, safe_reply, unsafe_reply, text_in_image, data_type + 'Racial_')
                 ids += 1 
                 data_out.append(new_entry_unsafe_image)
 
-            elif 'harmful' in json_path:
-                prompts = entry['questions']
-                for j, question in enumerate(prompts): 
-                    
-                    image = 'RedTeamingVLM/data/Harmful/img/' + str(entry['index']) + '.jpg'
-                    assert verify_image_exists(image)
-                    old_id = 'Harmful_' + str(entry['index'])
-                    safe_image = True
-                    harmful_category= 'deception'
-                    harmful_subcategory= 'disinformation'
-                    safe_prompt = True
-                    safe_comb = False 
-                    prompt = question
-                    safe_reply = entry['answers'][j]
-                    unsafe_reply= None
-                    text_in_image= None
-                    new_entry_unsafe_image = create_entry_RTVLM(ids, old_id, image, safe_image, harmful_category, harmful_subcategory, safe_prompt, safe_comb, prompt, safe_reply, unsafe_reply, text_in_image, data_type + 'Racial_')
-                    ids += 1 
-                    data_out.append(new_entry_unsafe_image)            
+    return data_out
 
+def add_data_RTVLM(id_start = 0, data_type = 'RTVLM_', json_paths = json_paths_RTVLM):
+    data_out = []
+    # The ids run on from one file to the next
+    for json_path in json_paths:
+        data_out += add_data_RTVLM_file(json_path, id_start + len(data_out), data_type)
     return data_out
 
-def add_data_FigStep(id_start = 0, data_type = 'FigStep_'):
+def add_data_FigStep(id_start = 0, data_type = 'FigStep_', csv_path = csv_path_FigStep):
+    import pandas as pd
     data_out = []
     img_path = 'FigStep/data/images/SafeBench-Tiny/'
-    csv_path = '/share/users/sara.pieri/Judge/FigStep/data/question/SafeBench-Tiny.csv'
-    data = pd.read_csv(csv_path)
+    data = pd.read_csv(csv_path, usecols=['category_id', 'task_id'])
     ids = 0 + id_start
     print(f"Id start", id_start)
-    for index, row in data.iterrows():
-        image = img_path + 'query_ForbidQI_' + str(row['category_id']) + '_' + str(row['task_id']) + '_6.png'
+    for index, category_id, task_id in zip(data.index, data['category_id'], data['task_id']):
+        image = img_path + 'query_ForbidQI_' + str(category_id) + '_' + str(task_id) + '_6.png'
         assert verify_image_exists(image)
         old_id = 'FigStep_' + str(index)
         safe_image = False
@@ -270,21 +298,258 @@ def add_data_FigStep(id_start = 0, data_type = 'FigStep_'):
         
         ids += 1
         data_out.append(new_entry_unsafe_image)
-        # Access fields using row['field_name']
-        # print(f"Row {index}: ForbidQI={row['dataset']}, Category ID={row['category_id']}, Task ID={row['task_id']}, Instruction={row['instruction']}")
     return data_out
 
-json_path_train = "/share/users/sara.pieri/Judge/VLGuard/train.json"
-json_path_test = "/share/users/sara.pieri/Judge/VLGuard/test.json" 
-out_json = "/share/users/sara.pieri/Judge/dataset.json"
+def shift_ids(entries, segments):
+    """
+    Adds offsets to the numeric suffix of the entry ids of a stage built from id 0.
 
-data_train_VLGuard = add_data_VLGuard(json_path_train)
-data_test_VLGuard = add_data_VLGuard(json_path_test, id_start = 0, data_type = 'VLGuard_test_') # len(data_train_VLGuard),
-data_rtvlm = add_data_RTVLM(id_start = 0, data_type = 'RTVLM_') # len(data_train_VLGuard) + len(data_test_VLGuard) 
-data_figstep = add_data_FigStep(id_start = len(data_train_VLGuard) + len(data_test_VLGuard) + len(data_rtvlm), data_type = 'FigStep_') 
+    Args:
+        entries (list): The entries of the stage, numbered from 0.
+        segments (list): [first local id, offset] pairs in increasing order, each offset applying
+            from its first local id to the next segment, e.g. [[0, 12]] for a contiguous range.
 
-combined = data_train_VLGuard + data_test_VLGuard + data_rtvlm + data_figstep
-counts = count_harmful_categories(combined) 
-print(counts)
-    
-save_to_json_file(combined, out_json, 'w')
+    Returns:
+        list: Copies of the entries with the shifted ids.
+    """
+    shifted = []
+    for entry in entries:
+        prefix, index = entry['id'].rsplit('_', 1)
+        offset = [offset for start, offset in segments if start <= int(index)][-1]
+        shifted.append(dict(entry, id=prefix + '_' + str(int(index) + offset)))
+    return shifted
+
+def id_numbers(entries, segments):
+    return [tuple(entry['id'].rsplit('_', 1)) for entry in shift_ids(entries, segments)]
+
+def id_prefixes(entries):
+    return {entry['id'].rsplit('_', 1)[0] for entry in entries}
+
+class BuildManifest:
+    """
+    JSON manifest of a dataset build: for each stage, the size, modification time and SHA-256 of
+    its source file, the entries it produced (numbered from 0) and the id offsets they were given,
+    as segments of `shift_ids` (manifests with a single `offset` are read as one segment).
+
+    Args:
+        file_path (str): The filesystem path of the manifest.
+    """
+
+    version = 1
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.stages = {}
+        self.keys = []
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as file:
+                manifest = json.load(file)
+            # Entries built by another version of the builder are not reused
+            if manifest.get("version") == self.version:
+                self.stages = manifest["stages"]
+
+    def get(self, key, source_path):
+        """
+        Returns the record of a stage if its source file did not change.
+
+        A file with a new size or modification time is hashed, so that a touched but identical
+        file is still reused.
+
+        Args:
+            key (str): The key of the stage.
+            source_path (str): The source file of the stage.
+
+        Returns:
+            dict: The record of the stage, or None if the stage must be built again.
+        """
+        record = self.stages.get(key)
+        if record is None:
+            return None
+        stat = os.stat(source_path)
+        if record["size"] != stat.st_size:
+            return None
+        if record["mtime_ns"] != stat.st_mtime_ns:
+            if record["sha256"] != file_sha256(source_path):
+                return None
+            record["mtime_ns"] = stat.st_mtime_ns
+        self.keys.append(key)
+        return record
+
+    def put(self, key, source_path, entries, segments):
+        """
+        Records the entries built by a stage from the current version of its source file.
+
+        Args:
+            key (str): The key of the stage.
+            source_path (str): The source file of the stage.
+            entries (list): The entries of the stage, numbered from 0.
+            segments (list): The id offsets of the stage in the dataset, see `shift_ids`.
+        """
+        stat = os.stat(source_path)
+        self.stages[key] = {"source": source_path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                            "sha256": file_sha256(source_path), "segments": segments, "entries": entries}
+        self.keys.append(key)
+
+    def save(self):
+        """
+        Writes the manifest, keeping only the stages of the current build, replacing the previous
+        file atomically. Called once the outputs are written, so that an interrupted build is redone.
+        """
+        temporary_path = f"{self.file_path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump({"version": self.version, "stages": {key: self.stages[key] for key in self.keys}}, file)
+        os.replace(temporary_path, self.file_path)
+
+def stage_segments(record):
+    return record["segments"] if "segments" in record else [[0, record["offset"]]]
+
+def run_stage(stage):
+    function, arguments = stage
+    return function(*arguments)
+
+def stage_key(stage):
+    function, arguments = stage
+    return json.dumps([function.__name__] + list(arguments))
+
+def sequential_offsets(results):
+    """
+    Computes the id offsets of a sequential build: the RTVLM ids run on across its files and the
+    FigStep ids start after all the other entries.
+
+    Args:
+        results (list): The entries of each stage, numbered from 0, in stage order.
+
+    Returns:
+        list: The offset of each stage.
+    """
+    offsets = [0, 0]
+    rtvlm_length = 0
+    for data_file in results[2:-1]:
+        offsets.append(rtvlm_length)
+        rtvlm_length += len(data_file)
+    offsets.append(len(results[0]) + len(results[1]) + rtvlm_length)
+    return offsets
+
+def build_dataset(args, manifest=None):
+    """
+    Builds the entries of every source, each file in its own process.
+
+    Every stage numbers its entries from 0, and the ids are then offset as in a sequential build.
+    With a manifest, the stages whose source file did not change are not built again and keep
+    their ids. A rebuilt stage keeps its previous offsets unless its new ids would collide with
+    those of another stage. Then, if its previous entries are still the first ones of the stage,
+    only the new entries are numbered after the last id of their prefix, otherwise the whole stage is.
+
+    Args:
+        args: Command line arguments.
+        manifest (BuildManifest): The manifest of the previous build, updated with this one, or None.
+
+    Returns:
+        tuple: The combined entries in the order of the sources, and whether they may differ from
+        those of the previous build (always True without a manifest).
+    """
+    stages = [(add_data_VLGuard, (args.vlguard_train, 0, 'VLGuard_train_')),
+              (add_data_VLGuard, (args.vlguard_test, 0, 'VLGuard_test_'))]
+    stages += [(add_data_RTVLM_file, (json_path, 0, 'RTVLM_')) for json_path in args.rtvlm_files]
+    stages.append((add_data_FigStep, (0, 'FigStep_', args.figstep_csv)))
+    sources = [args.vlguard_train, args.vlguard_test] + list(args.rtvlm_files) + [args.figstep_csv]
+    keys = [stage_key(stage) for stage in stages]
+
+    records = [manifest.get(key, source) if manifest is not None else None for key, source in zip(keys, sources)]
+    pending = [index for index, record in enumerate(records) if record is None]
+    if args.workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=min(args.workers, len(pending))) as executor:
+            built = list(executor.map(run_stage, [stages[index] for index in pending]))
+    else:
+        built = [run_stage(stages[index]) for index in pending]
+    results = [record["entries"] if record is not None else None for record in records]
+    for index, entries in zip(pending, built):
+        results[index] = entries
+
+    segments = [[[0, offset]] for offset in sequential_offsets(results)]
+    if manifest is not None and manifest.stages:
+        # Unchanged stages keep their ids, rebuilt stages are placed around them
+        for index in range(len(stages)):
+            if records[index] is not None:
+                segments[index] = stage_segments(records[index])
+        used = {}
+        for index in range(len(stages)):
+            if records[index] is not None:
+                for prefix, number in id_numbers(results[index], segments[index]):
+                    used.setdefault(prefix, set()).add(int(number))
+
+        def collides(entries, stage_segments):
+            return any(int(number) in used.get(prefix, ()) for prefix, number in id_numbers(entries, stage_segments))
+
+        for index in pending:
+            entries = results[index]
+            old = manifest.stages.get(keys[index])
+            if old is not None:
+                segments[index] = stage_segments(old)
+            if collides(entries, segments[index]):
+                # Ids after the last one of every prefix of the stage
+                first_free = max((max(used[prefix]) for prefix in id_prefixes(entries) if used.get(prefix)), default=-1) + 1
+                kept = len(old["entries"]) if old is not None and entries[:len(old["entries"])] == old["entries"] else 0
+                if kept and not collides(entries[:kept], segments[index]):
+                    # Only the appended entries are renumbered, the previous ones keep their ids
+                    segments[index] = segments[index] + [[kept, first_free - kept]]
+                else:
+                    segments[index] = [[0, first_free]]
+            for prefix, number in id_numbers(entries, segments[index]):
+                used.setdefault(prefix, set()).add(int(number))
+
+    changed = manifest is None or bool(pending) or list(manifest.stages) != keys
+    if manifest is not None:
+        for index in pending:
+            manifest.put(keys[index], sources[index], results[index], segments[index])
+
+    combined = []
+    for entries, offsets in zip(results, segments):
+        combined += shift_ids(entries, offsets)
+    return combined, changed
+
+def main(args):
+    manifest = None
+    if not args.no_manifest:
+        manifest_file = args.manifest_file if args.manifest_file else os.path.splitext(args.output_file)[0] + '.manifest.json'
+        manifest = BuildManifest(manifest_file)
+        if args.full_rebuild:
+            manifest.stages = {}
+    combined, changed = build_dataset(args, manifest)
+
+    # Sidecar index of the image metadata, only the new and modified images are read
+    image_manifest_file = args.image_manifest_file if args.image_manifest_file else image_manifest_path(args.output_file)
+    image_metadata = write_image_manifest([entry['image'] for entry in combined], image_manifest_file, args.workers)
+    print(f"Image metadata saved to {image_manifest_file}")
+    unreadable = [image_path for image_path, metadata in image_metadata.items() if metadata.get("error")]
+    if unreadable:
+        print(f"{len(unreadable)} images could not be read, e.g. {unreadable[0]}: {image_metadata[unreadable[0]]['error']}")
+
+    if not changed and os.path.exists(args.output_file):
+        print(f"{args.output_file} is up to date")
+        manifest.save()
+        return
+    counts = count_harmful_categories(combined) 
+    print(counts)
+        
+    save_to_json_file(combined, args.output_file, 'w')
+
+    # Indexed store with the same entries, for consumers that only need a slice or a few fields
+    write_dataset_store(combined, os.path.splitext(args.output_file)[0])
+    if manifest is not None:
+        manifest.save()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build dataset.json from the VLGuard, RTVLM and FigStep sources.")
+    parser.add_argument("--vlguard_train", type=str, default=json_path_train, help="VLGuard train JSON file.")
+    parser.add_argument("--vlguard_test", type=str, default=json_path_test, help="VLGuard test JSON file.")
+    parser.add_argument("--rtvlm_files", type=str, nargs='+', default=json_paths_RTVLM, help="RTVLM JSONL files, in id order.")
+    parser.add_argument("--figstep_csv", type=str, default=csv_path_FigStep, help="FigStep SafeBench-Tiny CSV file.")
+    parser.add_argument("--output_file", type=str, default=out_json, help="Output JSON dataset, the indexed store is written next to it.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes building the source files in parallel (1 = sequential).")
+    parser.add_argument("--manifest_file", type=str, default=None, help="Manifest of the source files and the entries built from them. Defaults to the output file with a .manifest.json extension.")
+    parser.add_argument("--full_rebuild", action='store_true', help="Build every source again and renumber the ids as a sequential build, replacing the manifest. Without it, a changed source keeps its ids, or only its appended rows get new ones.")
+    parser.add_argument("--image_manifest_file", type=str, default=None, help="Sidecar index of the format, dimensions, animation flag, byte size and SHA-256 of every image. Defaults to the output file with a .images.json extension.")
+    parser.add_argument("--no_manifest", action='store_true', help="Build every source without reading or writing a manifest.")
+    args = parser.parse_args()
+    main(args)
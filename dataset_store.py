@@ -0,0 +1,235 @@
+import argparse
+import bisect
+import json
+import os
+
+''' Indexed Dataset Store '''
+
+# Fields are split in groups stored in separate JSONL files, so that readers that do not need the
+# long reply texts never read or parse them
+FIELD_GROUPS = {
+    "core": ["id", "old_id", "image", "safe_image", "harmful_category", "harmful_subcategory", "safe_prompt",
+             "safe_in_combination", "prompt", "text_in_image"],
+    "replies": ["safe_reply", "unsafe_reply"],
+}
+
+# Number of entries between two line offsets kept in the index
+INDEX_STRIDE = 1024
+
+def _index_file(base_path):
+    return base_path + '.index.json'
+
+def _store_base(data_file):
+    return data_file[:-len('.index.json')] if data_file.endswith('.index.json') else data_file
+
+def write_dataset_store(entries, base_path, field_groups=FIELD_GROUPS, stride=INDEX_STRIDE):
+    """
+    Writes the dataset as one compact JSONL file per field group plus a sparse index of line offsets.
+
+    The files written are `<base_path>.<group>.jsonl` and `<base_path>.index.json`. Fields that
+    are not listed in any group are stored in the last group. The index only keeps the offset of
+    every `stride`-th line of each file (and the file size), plus the ids sorted with their
+    position for lookups by id.
+
+    Args:
+        entries (list): The dataset entries.
+        base_path (str): Path prefix of the store.
+        field_groups (dict): Mapping from group name to the list of fields it holds.
+        stride (int): Number of entries between two offsets kept in the index.
+    """
+    field_groups = {name: list(fields) for name, fields in field_groups.items()}
+    known_fields = {field for fields in field_groups.values() for field in fields}
+    extra_fields = sorted({field for entry in entries for field in entry} - known_fields)
+    field_groups[list(field_groups)[-1]].extend(extra_fields)
+
+    # Ids sorted for a binary search, with the position of their entry
+    id_positions = sorted((entry["id"], position) for position, entry in enumerate(entries))
+    index = {"version": 2, "count": len(entries), "stride": stride, "groups": {},
+             "ids": {"sorted": [entry_id for entry_id, _ in id_positions], "positions": [position for _, position in id_positions]}}
+    for name, fields in field_groups.items():
+        file_path = f"{base_path}.{name}.jsonl"
+        offsets = []
+        with open(file_path, 'wb') as file:
+            for position, entry in enumerate(entries):
+                if position % stride == 0:
+                    offsets.append(file.tell())
+                file.write(json.dumps({field: entry.get(field) for field in fields}).encode() + b"\n")
+            offsets.append(file.tell())
+        index["groups"][name] = {"file": os.path.basename(file_path), "fields": fields, "offsets": offsets}
+
+    with open(_index_file(base_path), 'w') as file:
+        json.dump(index, file)
+    print(f"Saved {_index_file(base_path)}\nEntries {len(entries)}")
+
+class DatasetStore:
+    """
+    Reader of a store written by `write_dataset_store`.
+
+    Only the index is loaded when the store is opened. Slices are read with a single seek per
+    field group, to the indexed line at or before the slice, and only the groups holding the
+    requested fields are touched. Stores written with an offset for every line (version 1)
+    are read as a stride of one.
+
+    Args:
+        base_path (str): Path prefix of the store (or the path of its index file).
+    """
+
+    def __init__(self, base_path):
+        base_path = _store_base(base_path)
+        with open(_index_file(base_path), 'r') as file:
+            self.index = json.load(file)
+        self.directory = os.path.dirname(base_path)
+        self.stride = self.index.get("stride", 1)
+
+    def __len__(self):
+        return self.index["count"]
+
+    def _groups_for(self, fields):
+        groups = self.index["groups"]
+        if fields is None:
+            return list(groups)
+        return [name for name, group in groups.items() if any(field in group["fields"] for field in fields)]
+
+    def _group_path(self, name):
+        return os.path.join(self.directory, self.index["groups"][name]["file"])
+
+    def _read_group(self, name, start, end):
+        offsets = self.index["groups"][name]["offsets"]
+        # Whole blocks of `stride` lines around the slice, the lines outside it are not parsed
+        first_block = start // self.stride
+        last_block = min(-(-end // self.stride), len(offsets) - 1)
+        with open(self._group_path(name), 'rb') as file:
+            file.seek(offsets[first_block])
+            content = file.read(offsets[last_block] - offsets[first_block])
+        skip = start - first_block * self.stride
+        return [json.loads(line) for line in content.splitlines()[skip:skip + end - start]]
+
+    def read(self, start=0, end=None, fields=None):
+        """
+        Reads a contiguous slice of entries.
+
+        Args:
+            start (int): Index of the first entry.
+            end (int): Index after the last entry, None for the end of the dataset.
+            fields (list): Fields to load, None for all of them.
+
+        Returns:
+            list: The entries of the slice, restricted to the requested fields.
+        """
+        start, end, _ = slice(start, end).indices(len(self))
+        if start >= end:
+            return []
+        entries = None
+        for name in self._groups_for(fields):
+            rows = self._read_group(name, start, end)
+            if entries is None:
+                entries = rows
+            else:
+                for entry, row in zip(entries, rows):
+                    entry.update(row)
+        if fields is not None:
+            entries = [{field: entry.get(field) for field in fields} for entry in entries]
+        return entries
+
+    def iter(self, fields=None, batch_size=1000):
+        """
+        Streams all entries in dataset order, reading `batch_size` entries at a time.
+
+        Args:
+            fields (list): Fields to load, None for all of them.
+            batch_size (int): Number of entries read per batch.
+
+        Yields:
+            dict: The next entry, restricted to the requested fields.
+        """
+        for start in range(0, len(self), batch_size):
+            yield from self.read(start, start + batch_size, fields)
+
+    def get(self, entry_id, fields=None):
+        """
+        Reads the entry with the given id, found by a binary search of the sorted ids of the index.
+        Stores written without them are scanned instead.
+
+        Args:
+            entry_id (str): The entry id.
+            fields (list): Fields to load, None for all of them.
+
+        Returns:
+            dict: The entry, or None if the id is not in the dataset.
+        """
+        ids = self.index.get("ids")
+        if ids is not None:
+            found = bisect.bisect_left(ids["sorted"], entry_id)
+            if found == len(ids["sorted"]) or ids["sorted"][found] != entry_id:
+                return None
+            return self.read(ids["positions"][found], ids["positions"][found] + 1, fields)[0]
+
+        name = self._groups_for(["id"])[0]
+        key = json.dumps(entry_id).encode()
+        with open(self._group_path(name), 'rb') as file:
+            for position, line in enumerate(file):
+                # Only the lines that contain the id are parsed
+                if key in line and json.loads(line).get("id") == entry_id:
+                    return self.read(position, position + 1, fields)[0]
+        return None
+
+def is_dataset_store(data_file):
+    """
+    Checks whether a data file path refers to a dataset store rather than a JSON dataset.
+
+    Args:
+        data_file (str): Path of the JSON dataset, or path prefix (or index file) of a store.
+
+    Returns:
+        bool: True if the path refers to a store.
+    """
+    return os.path.exists(_index_file(_store_base(data_file)))
+
+def load_entries(data_file, start_index=0, end_index=None, fields=None):
+    """
+    Loads a slice of the dataset from either a JSON dataset file or a dataset store.
+
+    Args:
+        data_file (str): Path of the JSON dataset, or path prefix (or index file) of a store.
+        start_index (int): Index of the first entry.
+        end_index (int): Index after the last entry, None for the end of the dataset.
+        fields (list): Fields to load, None for all of them.
+
+    Returns:
+        list: The entries of the slice, restricted to the requested fields.
+    """
+    if is_dataset_store(data_file):
+        return DatasetStore(data_file).read(start_index, end_index, fields)
+
+    with open(data_file, 'r') as file:
+        data = json.load(file)[start_index:end_index]
+    if fields is not None:
+        data = [{field: entry.get(field) for field in fields} for entry in data]
+    return data
+
+def iter_entries(data_file, fields=None, batch_size=1000):
+    """
+    Streams the entries of a JSON dataset file or a dataset store in dataset order.
+
+    A store is read `batch_size` entries at a time, so the whole dataset is never held in memory.
+
+    Args:
+        data_file (str): Path of the JSON dataset, or path prefix (or index file) of a store.
+        fields (list): Fields to load, None for all of them.
+        batch_size (int): Number of entries read per batch from a store.
+
+    Yields:
+        dict: The next entry, restricted to the requested fields.
+    """
+    if is_dataset_store(data_file):
+        yield from DatasetStore(data_file).iter(fields, batch_size)
+    else:
+        yield from load_entries(data_file, fields=fields)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a JSON dataset to an indexed dataset store.")
+    parser.add_argument("--data_file", type=str, default='./dataset.json', help="Path to the JSON file with data.")
+    parser.add_argument("--output", type=str, default='./dataset', help="Path prefix of the dataset store.")
+    args = parser.parse_args()
+    with open(args.data_file, 'r') as file:
+        write_dataset_store(json.load(file), args.output)
@@ -0,0 +1,247 @@
+import argparse
+import json
+import os
+from functools import lru_cache
+from dataset_store import load_entries
+from image_metadata import DimensionsCache, probe_images
+
+''' Perceptual Hashing and Near-Duplicate Image Clusters '''
+
+@lru_cache(maxsize=None)
+def _dct_matrix(size):
+    import numpy as np
+    # Orthonormal DCT-II basis, so that the 2D transform of an image is D @ X @ D.T
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+def perceptual_hash(image_path, hash_size=8, highfreq_factor=4):
+    """
+    Computes the DCT perceptual hash of an image.
+
+    The image is converted to grayscale and shrunk to (hash_size * highfreq_factor) pixels square,
+    then each bit of the hash tells whether one of the hash_size x hash_size lowest frequency DCT
+    coefficients is above their median. Re-encoded, rescaled or slightly edited copies of an image
+    get hashes a few bits apart.
+
+    Args:
+        image_path (str): The filesystem path to the image file.
+        hash_size (int): Side of the block of coefficients kept, the hash has hash_size ** 2 bits.
+        highfreq_factor (int): Ratio between the side of the shrunk image and hash_size.
+
+    Returns:
+        int: The hash.
+
+    Raises:
+        IOError: If the file cannot be opened or is not an image.
+    """
+    import numpy as np
+    from PIL import Image
+    size = hash_size * highfreq_factor
+    with Image.open(image_path) as img:
+        # JPEG images are decoded directly at a reduced scale
+        img.draft('L', (size, size))
+        pixels = np.asarray(img.convert('L').resize((size, size), Image.LANCZOS), dtype=np.float64)
+    dct = _dct_matrix(size)
+    # Rounded so that the floating point noise of flat images does not decide their bits
+    low_frequencies = np.round((dct @ pixels @ dct.T)[:hash_size, :hash_size], 6)
+    bits = (low_frequencies > np.median(low_frequencies)).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hash_record(image_path):
+    # Stored in the hash cache as a hexadecimal string, None for unreadable images
+    try:
+        return {"phash": format(perceptual_hash(image_path), '016x')}
+    except (IOError, ValueError):
+        return {"phash": None}
+
+def hash_images(image_paths, workers=1, hash_cache=None):
+    """
+    Computes the perceptual hash of a set of images, in a process pool when `workers` is greater
+    than one, through a persistent cache keyed by path, size and modification time. Missing files
+    are not cached and get a None hash like unreadable ones.
+
+    Args:
+        image_paths (iterable): The filesystem paths to the images.
+        workers (int): Number of worker processes.
+        hash_cache (str): Path of the JSON hash cache, or None.
+
+    Returns:
+        dict: Mapping from each image path to its hash, or None if the image cannot be read.
+    """
+    cache = DimensionsCache(hash_cache)
+    records = probe_images(image_paths, workers, cache, probe=hash_record)
+    cache.save()
+    return {image_path: int(record["phash"], 16) if record["phash"] else None for image_path, record in records.items()}
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """
+    Burkhard-Keller tree of hashes under the Hamming distance.
+
+    Every child of a node is stored under its distance to the node, so a search for the hashes
+    within `radius` of a query at distance d of a node only descends into the children at
+    distances d - radius to d + radius.
+    """
+
+    def __init__(self):
+        # A node is [hash, items, {distance: child node}]
+        self.root = None
+
+    def add(self, value, item):
+        """
+        Inserts an item under its hash.
+
+        Args:
+            value (int): The hash.
+            item: The object stored, returned by `search`.
+        """
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """
+        Finds the items whose hash is within a Hamming radius of a query hash.
+
+        Args:
+            value (int): The query hash.
+            radius (int): The maximum number of differing bits.
+
+        Returns:
+            list: The (distance, item) pairs found.
+        """
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= radius:
+                found.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    nodes.append(child)
+        return found
+
+def cluster_images(hashes, radius):
+    """
+    Groups images whose hashes are within `radius` bits of each other.
+
+    Clusters are the connected components of the "within radius" relation, so a chain of close
+    images can put two images further apart than `radius` in the same cluster.
+
+    Args:
+        hashes (dict): Mapping from image paths to their hash, or None for unreadable images.
+        radius (int): The maximum Hamming distance between two near-duplicates.
+
+    Returns:
+        list: The clusters as sorted lists of image paths, largest first. Unreadable images are
+        clusters of their own.
+    """
+    tree = BKTree()
+    paths_by_hash = {}
+    for image_path, value in hashes.items():
+        if value is not None:
+            if value not in paths_by_hash:
+                tree.add(value, value)
+            paths_by_hash.setdefault(value, []).append(image_path)
+
+    # Union-find over the distinct hashes
+    parents = {value: value for value in paths_by_hash}
+
+    def find(value):
+        while parents[value] != value:
+            parents[value] = parents[parents[value]]
+            value = parents[value]
+        return value
+
+    for value in paths_by_hash:
+        for _, neighbor in tree.search(value, radius):
+            root, neighbor_root = find(value), find(neighbor)
+            if root != neighbor_root:
+                parents[neighbor_root] = root
+
+    clusters = {}
+    for value, paths in paths_by_hash.items():
+        clusters.setdefault(find(value), []).extend(paths)
+    clusters = [sorted(paths) for paths in clusters.values()]
+    clusters += [[image_path] for image_path, value in hashes.items() if value is None]
+    return sorted(clusters, key=lambda paths: (-len(paths), paths[0]))
+
+def group_entries(data, clusters):
+    """
+    Groups the entries that show near-duplicate images with the same text prompt, which a judge
+    would answer alike.
+
+    Args:
+        data (list): The dataset entries, with their `image` and `prompt`.
+        clusters (list): The image clusters, see `cluster_images`.
+
+    Returns:
+        list: The groups of entries in dataset order, each starting with the entry to judge.
+    """
+    cluster_of = {image_path: index for index, paths in enumerate(clusters) for image_path in paths}
+    groups = {}
+    for entry in data:
+        key = (cluster_of.get(entry["image"], entry["image"]), entry["prompt"])
+        groups.setdefault(key, []).append(entry)
+    return list(groups.values())
+
+def main(args):
+    data = load_entries(args.data_file, fields=["id", "image", "prompt"])
+    image_paths = sorted({entry["image"] for entry in data})
+    hashes = hash_images(image_paths, args.workers, args.hash_cache)
+    clusters = cluster_images(hashes, args.radius)
+    duplicates = [paths for paths in clusters if len(paths) > 1]
+    groups = group_entries(data, clusters)
+    unreadable = sorted(image_path for image_path, value in hashes.items() if value is None)
+
+    print("--------------------------------")
+    print(f"Near-duplicate images of {args.data_file} (radius {args.radius} bits):")
+    print(f"Images: {len(image_paths)} ({len(unreadable)} missing or unreadable, judged on their own), clusters: {len(clusters)}, "
+          f"clusters with duplicates: {len(duplicates)} ({sum(len(paths) for paths in duplicates)} images)")
+    # Identical (image, prompt) pairs are already answered once by the response cache
+    exact = len({(entry["image"], entry["prompt"]) for entry in data})
+    print(f"Judge requests: {len(data)} entries, {len(groups)} distinct (cluster, prompt) pairs, "
+          f"{len(data) - len(groups)} saved ({(len(data) - len(groups)) / len(data) * 100 if data else 0:.2f}%), "
+          f"{exact - len(groups)} of them beyond identical (image, prompt) pairs")
+    if unreadable:
+        print(f"Missing or unreadable: {', '.join(unreadable[:5])}{' ...' if len(unreadable) > 5 else ''}")
+    for paths in duplicates[:args.show]:
+        print(f"\n{len(paths)} images:")
+        for image_path in paths[:5]:
+            print(f"  {image_path}")
+        if len(paths) > 5:
+            print(f"  ... and {len(paths) - 5} more")
+    print("--------------------------------")
+
+    if args.report_file:
+        with open(args.report_file, 'w') as file:
+            json.dump({"radius": args.radius, "clusters": duplicates, "unreadable": unreadable,
+                       "groups": [[entry["id"] for entry in group] for group in groups if len(group) > 1]}, file, indent=4)
+        print(f"Clusters saved to {args.report_file}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find near-duplicate images of a dataset with perceptual hashes.")
+    parser.add_argument("--data_file", type=str, default='./dataset.json', help="Path to the JSON dataset, or path prefix of an indexed dataset store.")
+    parser.add_argument("--radius", type=int, default=4, help="Maximum number of differing bits (out of 64) between near-duplicate images.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes hashing the images.")
+    parser.add_argument("--hash_cache", type=str, default='./image_hashes.json', help="JSON file caching the hashes by path, size and modification time.")
+    parser.add_argument("--show", type=int, default=10, help="Number of the largest clusters printed.")
+    parser.add_argument("--report_file", type=str, default=None, help="JSON file to save the clusters and the groups of entries judged together.")
+    args = parser.parse_args()
+    main(args)
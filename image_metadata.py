@@ -0,0 +1,375 @@
+import hashlib
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+''' Image Header Probing and Dimensions Cache '''
+
+# Largest image file accepted by the API, and the formats it reads
+MAX_UPLOAD_BYTES = 20 * 2**20
+SUPPORTED_FORMATS = {'PNG', 'JPEG', 'WEBP', 'GIF'}
+
+def _png_metadata(file, header):
+    width, height = struct.unpack('>II', header[16:24])
+    # An APNG declares its animation control chunk before the first image data chunk
+    animated = False
+    file.seek(8)
+    while True:
+        chunk = file.read(8)
+        if len(chunk) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', chunk)
+        if chunk_type == b'acTL':
+            animated = True
+            break
+        if chunk_type in (b'IDAT', b'IEND'):
+            break
+        file.seek(length + 4, os.SEEK_CUR)
+    return {"format": "PNG", "width": width, "height": height, "animated": animated}
+
+def _jpeg_metadata(file):
+    file.seek(2)
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        # Skip fill bytes between markers
+        while marker[1] == 0xFF:
+            marker = marker[1:] + file.read(1)
+        code = marker[1]
+        if code in (0x01, 0xD8) or 0xD0 <= code <= 0xD7:
+            continue
+        length = struct.unpack('>H', file.read(2))[0]
+        # Start of frame markers, excluding DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>xHH', file.read(5))
+            return {"format": "JPEG", "width": width, "height": height, "animated": False}
+        file.seek(length - 2, os.SEEK_CUR)
+
+def _skip_gif_sub_blocks(file):
+    while True:
+        size = file.read(1)
+        if not size or size[0] == 0:
+            return
+        file.seek(size[0], os.SEEK_CUR)
+
+def _gif_metadata(file, header):
+    width, height, flags = struct.unpack('<HHB', header[6:11])
+    file.seek(13 + (3 << ((flags & 0x07) + 1) if flags & 0x80 else 13))
+    # Count the image descriptors, stopping at the second one
+    frames = 0
+    while frames < 2:
+        block = file.read(1)
+        if not block or block == b'\x3b':
+            break
+        if block == b'\x21':
+            file.seek(1, os.SEEK_CUR)
+            _skip_gif_sub_blocks(file)
+        elif block == b'\x2c':
+            frames += 1
+            descriptor = file.read(9)
+            if len(descriptor) < 9:
+                break
+            if descriptor[8] & 0x80:
+                file.seek(3 << ((descriptor[8] & 0x07) + 1), os.SEEK_CUR)
+            file.seek(1, os.SEEK_CUR)
+            _skip_gif_sub_blocks(file)
+        else:
+            break
+    return {"format": "GIF", "width": width, "height": height, "animated": frames > 1}
+
+def _webp_metadata(header):
+    chunk_type = header[12:16]
+    if chunk_type == b'VP8 ':
+        width, height = struct.unpack('<HH', header[26:30])
+        width, height = width & 0x3FFF, height & 0x3FFF
+        animated = False
+    elif chunk_type == b'VP8L':
+        bits = struct.unpack('<I', header[21:25])[0]
+        width, height = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        animated = False
+    elif chunk_type == b'VP8X':
+        animated = bool(header[20] & 0x02)
+        width = int.from_bytes(header[24:27], 'little') + 1
+        height = int.from_bytes(header[27:30], 'little') + 1
+    else:
+        return None
+    return {"format": "WEBP", "width": width, "height": height, "animated": animated}
+
+def probe_image(image_path):
+    """
+    Reads the format, dimensions and animation flag of an image from its header.
+
+    PNG, JPEG, GIF and WEBP headers are parsed directly, reading only a few hundred bytes in
+    most cases. Other formats, and headers that cannot be parsed, are handed to PIL, which
+    also only reads the header of the file.
+
+    Args:
+        image_path (str): The filesystem path to the image file.
+
+    Returns:
+        dict: The `format` (as named by PIL), `width`, `height` and `animated` of the image.
+
+    Raises:
+        IOError: If the file cannot be opened or is not an image.
+    """
+    metadata = None
+    with open(image_path, 'rb') as file:
+        header = file.read(32)
+        try:
+            if header.startswith(b'\x89PNG\r\n\x1a\n') and header[12:16] == b'IHDR':
+                metadata = _png_metadata(file, header)
+            elif header.startswith(b'\xff\xd8'):
+                metadata = _jpeg_metadata(file)
+            elif header[:6] in (b'GIF87a', b'GIF89a'):
+                metadata = _gif_metadata(file, header)
+            elif header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+                metadata = _webp_metadata(header)
+        except struct.error:
+            metadata = None
+
+    if metadata is None:
+        from PIL import Image
+        with Image.open(image_path) as img:
+            metadata = {"format": img.format, "width": img.size[0], "height": img.size[1],
+                        "animated": bool(getattr(img, "is_animated", False))}
+    return metadata
+
+def file_sha256(file_path):
+    """
+    Computes the SHA-256 of a file, reading it in 1 MB chunks.
+
+    Args:
+        file_path (str): The filesystem path to the file.
+
+    Returns:
+        str: The hexadecimal digest of the file bytes.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def describe_image(image_path):
+    """
+    Collects the metadata of an image recorded in the image manifest: the header fields of
+    `probe_image`, plus the size of the file in bytes and the SHA-256 of its content.
+
+    A missing or unreadable file, or one that is not an image, does not raise: it is described
+    by a placeholder with a null format and the `error` that was met.
+
+    Args:
+        image_path (str): The filesystem path to the image file.
+
+    Returns:
+        dict: The `format`, `width`, `height`, `animated`, `bytes` and `sha256` of the image, or
+        the placeholder with an `error` field.
+    """
+    try:
+        metadata = probe_image(image_path)
+        metadata["bytes"] = os.path.getsize(image_path)
+        metadata["sha256"] = file_sha256(image_path)
+    except (OSError, ValueError) as e:
+        return {"format": None, "width": None, "height": None, "animated": False, "bytes": None, "sha256": None,
+                "error": f"{type(e).__name__}: {e}"}
+    return metadata
+
+def upload_problems(metadata):
+    """
+    Lists the reasons why an image cannot be sent to the API as it is.
+
+    Args:
+        metadata (dict): The metadata of the image, see `describe_image`. Without a `bytes` field
+            the file size is not checked.
+
+    Returns:
+        list: The problems found, empty if the image can be uploaded.
+    """
+    if metadata.get("error"):
+        return [f"unreadable ({metadata['error']})"]
+    problems = []
+    if metadata["format"] not in SUPPORTED_FORMATS:
+        problems.append(f"unsupported format {metadata['format']}")
+    if metadata["format"] == 'GIF' and metadata["animated"]:
+        problems.append("animated GIF")
+    if (metadata.get("bytes") or 0) > MAX_UPLOAD_BYTES:
+        problems.append(f"{metadata['bytes'] / 2**20:.1f} MB, over the {MAX_UPLOAD_BYTES // 2**20} MB limit")
+    return problems
+
+def image_manifest_path(data_file):
+    """
+    Returns the default path of the image manifest written by create_dataset.py next to a dataset.
+
+    Args:
+        data_file (str): The JSON dataset, or the path prefix of an indexed dataset store.
+
+    Returns:
+        str: The path of the manifest, e.g. ./dataset.images.json for ./dataset.json,
+        ./dataset or ./dataset.index.json.
+    """
+    # The index file of a store names the same dataset as its path prefix
+    if data_file.endswith('.index.json'):
+        return data_file[:-len('.index.json')] + '.images.json'
+    return os.path.splitext(data_file)[0] + '.images.json'
+
+class DimensionsCache:
+    """
+    Persistent JSON cache of `probe_image` results keyed by image path.
+
+    An entry is only used while the size and modification time of the file are unchanged, so
+    edited images are probed again.
+
+    Args:
+        file_path (str): The filesystem path of the JSON cache, or None for an in-memory cache.
+    """
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        self.entries = {}
+        self.modified = False
+        if file_path and os.path.exists(file_path):
+            with open(file_path, 'r') as file:
+                self.entries = json.load(file)
+
+    def get(self, image_path, stat):
+        """
+        Returns the cached metadata of an image if the file did not change.
+
+        Args:
+            image_path (str): The filesystem path to the image file.
+            stat (os.stat_result): The current stat of the file.
+
+        Returns:
+            dict: The cached metadata, or None.
+        """
+        item = self.entries.get(image_path)
+        if item and item["size"] == stat.st_size and item["mtime_ns"] == stat.st_mtime_ns:
+            return item["metadata"]
+        return None
+
+    def lookup(self, image_path):
+        """
+        Returns the cached metadata of an image if the file did not change, checking it with a
+        stat call only.
+
+        Args:
+            image_path (str): The filesystem path to the image file.
+
+        Returns:
+            dict: The cached metadata, or None if the image is not cached, changed or is missing.
+        """
+        if image_path not in self.entries:
+            return None
+        try:
+            return self.get(image_path, os.stat(image_path))
+        except OSError:
+            return None
+
+    def update(self, other):
+        """
+        Adds the entries of another cache for the images this one does not have, e.g. those of
+        the image manifest, which has the same format.
+
+        Args:
+            other (DimensionsCache): The cache to read the entries from.
+        """
+        for image_path, item in other.entries.items():
+            self.entries.setdefault(image_path, item)
+
+    def put(self, image_path, stat, metadata):
+        """
+        Stores the metadata of an image.
+
+        Args:
+            image_path (str): The filesystem path to the image file.
+            stat (os.stat_result): The stat of the file when it was probed.
+            metadata (dict): The result of `probe_image`.
+        """
+        self.entries[image_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "metadata": metadata}
+        self.modified = True
+
+    def save(self):
+        """
+        Writes the cache to disk if it changed, replacing the previous file atomically.
+        """
+        if not self.file_path or not self.modified:
+            return
+        temporary_path = f"{self.file_path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump(self.entries, file)
+        os.replace(temporary_path, self.file_path)
+        self.modified = False
+
+def probe_images(image_paths, workers=1, cache=None, probe=probe_image):
+    """
+    Probes the headers of a set of images, in a process pool when `workers` is greater than one.
+
+    Args:
+        image_paths (iterable): The filesystem paths to the images.
+        workers (int): Number of worker processes (1 = probe in the current process).
+        cache (DimensionsCache): Cache consulted before probing and updated with the new results.
+        probe (callable): The function reading the metadata of one image, `probe_image` or `describe_image`.
+
+    Returns:
+        dict: Mapping from each image path to the result of `probe`.
+    """
+    from tqdm import tqdm
+    image_paths = sorted(set(image_paths))
+    results = {}
+    missing = []
+    stats = {}
+    for image_path in image_paths:
+        # A file that cannot be stat'ed is never cached, the probe decides how it is reported
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            stat = None
+        metadata = cache.get(image_path, stat) if cache is not None and stat is not None else None
+        if metadata is None:
+            stats[image_path] = stat
+            missing.append(image_path)
+        else:
+            results[image_path] = metadata
+
+    if missing:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                probed = list(tqdm(executor.map(probe, missing, chunksize=64), total=len(missing), desc="Probing images"))
+        else:
+            probed = [probe(image_path) for image_path in tqdm(missing, desc="Probing images")]
+        for image_path, metadata in zip(missing, probed):
+            results[image_path] = metadata
+            if cache is not None and stats[image_path] is not None:
+                cache.put(image_path, stats[image_path], metadata)
+    return results
+
+def write_image_manifest(image_paths, file_path, workers=1):
+    """
+    Writes the image manifest of a dataset: the metadata of `describe_image` for every distinct
+    image, keyed by path, in the format of `DimensionsCache`. The entries of an existing manifest
+    are reused for the images whose size and modification time did not change. Images that cannot
+    be read are recorded with the placeholder of `describe_image`.
+
+    Args:
+        image_paths (iterable): The image paths of the dataset entries.
+        file_path (str): The filesystem path of the manifest.
+        workers (int): Number of worker processes.
+
+    Returns:
+        dict: Mapping from each image path to its metadata.
+    """
+    manifest = DimensionsCache(file_path)
+    image_paths = set(image_paths)
+    metadata = probe_images(image_paths, workers, manifest, probe=describe_image)
+    # Missing files have no size and modification time to be cached with, they are probed again on every build
+    for image_path in image_paths - set(manifest.entries):
+        manifest.entries[image_path] = {"size": None, "mtime_ns": None, "metadata": metadata[image_path]}
+        manifest.modified = True
+    # Drop the images that are no longer in the dataset
+    if set(manifest.entries) != image_paths:
+        manifest.entries = {image_path: manifest.entries[image_path] for image_path in image_paths}
+        manifest.modified = True
+    manifest.save()
+    return metadata
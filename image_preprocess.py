@@ -0,0 +1,136 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+''' Image Downscaling for OpenAI Detail Levels '''
+
+# Part of the cache key of the renditions, bumped when the target sizes change
+RENDITION_VERSION = 2
+
+def target_size(width, height, detail):
+    """
+    Computes the resolution the API actually consumes for an image at the given detail level.
+
+    For 'low' detail the model only sees a 512px version of the image. For 'high' detail the image
+    is scaled to fit within 2048x2048 and then so that its shortest side is 768 pixels, as in
+    `compute_tokens_image`. Images are never upscaled, since that would only add bytes.
+
+    Args:
+        width (int): The width of the image in pixels.
+        height (int): The height of the image in pixels.
+        detail (str): The detail level ('low' or 'high').
+
+    Returns:
+        tuple: The target width and height in pixels.
+
+    Raises:
+        ValueError: If 'detail' is not 'low' or 'high'.
+
+    Examples:
+        >>> target_size(2048, 4096, 'high')
+        (768, 1536)
+        >>> target_size(4000, 3000, 'high')
+        (1024, 768)
+        >>> target_size(4096, 4096, 'high')
+        (768, 768)
+        >>> target_size(600, 400, 'high')
+        (600, 400)
+        >>> target_size(1024, 768, 'low')
+        (512, 384)
+    """
+    if detail == 'low':
+        scale = min(1.0, 512 / max(width, height))
+    elif detail == 'high':
+        scale = min(1.0, 2048 / max(width, height))
+        # Applied after the first step, to the shortest side of the image that fits in 2048x2048
+        scale *= min(1.0, 768 / (min(width, height) * scale))
+    else:
+        raise ValueError("Detail must be 'low' or 'high'")
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def preprocessed_path(image_path, detail, cache_dir):
+    """
+    Returns the cache path of the downscaled rendition of an image.
+
+    The name is derived from the absolute path, size and modification time of the source, so
+    the rendition is regenerated when the source image changes, and from `RENDITION_VERSION`.
+
+    Args:
+        image_path (str): The filesystem path to the source image.
+        detail (str): The detail level ('low' or 'high').
+        cache_dir (str): Directory holding the downscaled images.
+
+    Returns:
+        str: The path of the downscaled image, with the extension of the source format.
+    """
+    stat = os.stat(image_path)
+    key = f"{os.path.abspath(image_path)}:{stat.st_size}:{stat.st_mtime_ns}:{detail}:{RENDITION_VERSION}"
+    extension = '.png' if image_path.lower().endswith(('.png', '.gif')) else '.jpg'
+    return os.path.join(cache_dir, detail, hashlib.sha256(key.encode()).hexdigest() + extension)
+
+def preprocess_image(image_path, detail, cache_dir):
+    """
+    Downscales an image to the resolution consumed by the API and caches the result on disk.
+
+    PNG and GIF images are re-encoded losslessly as PNG, other formats as high quality JPEG.
+
+    Args:
+        image_path (str): The filesystem path to the source image.
+        detail (str): The detail level ('low' or 'high').
+        cache_dir (str): Directory holding the downscaled images.
+
+    Returns:
+        str: The path of the image to upload, which is the source itself if it is already small enough
+        or cannot be read.
+    """
+    from PIL import Image
+    try:
+        output_path = preprocessed_path(image_path, detail, cache_dir)
+        if os.path.exists(output_path):
+            return output_path
+
+        with Image.open(image_path) as img:
+            width, height = img.size
+            size = target_size(width, height, detail)
+            if size == (width, height):
+                return image_path
+            resized = img.resize(size, Image.LANCZOS)
+
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        # Write to a temporary name first so that concurrent runs never read a partial file
+        temporary_path = f"{output_path}.{os.getpid()}.tmp"
+        if output_path.endswith('.png'):
+            resized.save(temporary_path, format='PNG')
+        else:
+            if resized.mode not in ('RGB', 'L'):
+                resized = resized.convert('RGB')
+            resized.save(temporary_path, format='JPEG', quality=95)
+        os.replace(temporary_path, output_path)
+        return output_path
+
+    except (IOError, ValueError) as e:
+        print(f"Could not preprocess {image_path}, uploading the original: {e}")
+        return image_path
+
+def _preprocess_job(job):
+    return preprocess_image(*job)
+
+def preprocess_images(image_paths, detail, cache_dir, workers=None):
+    """
+    Downscales a set of images in a process pool.
+
+    Args:
+        image_paths (iterable): The filesystem paths to the source images.
+        detail (str): The detail level ('low' or 'high').
+        cache_dir (str): Directory holding the downscaled images.
+        workers (int): Number of worker processes, defaults to the number of CPUs.
+
+    Returns:
+        dict: Mapping from each source path to the path of the image to upload.
+    """
+    from tqdm import tqdm
+    image_paths = sorted(set(image_paths))
+    jobs = [(image_path, detail, cache_dir) for image_path in image_paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(tqdm(executor.map(_preprocess_job, jobs, chunksize=16), total=len(jobs), desc="Downscaling images"))
+    return dict(zip(image_paths, results))
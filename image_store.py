@@ -0,0 +1,181 @@
+import base64
+import hashlib
+import json
+import mmap
+import os
+
+''' Pre-encoded Image Store '''
+
+def _store_files(store_path):
+    return store_path + '.b64', store_path + '.index.json'
+
+def build_image_store(image_paths, store_path):
+    """
+    Base64-encodes images once into a single blob file, with a JSON index by image path.
+
+    Identical images are stored once and shared by all their paths. An existing store is
+    updated in place: images whose size and modification time did not change are not read again.
+    Missing or unreadable images are left out of the index, so that their requests encode them
+    (and fail) on their own.
+
+    Args:
+        image_paths (iterable): The filesystem paths of the images to store.
+        store_path (str): Path prefix of the store, the files `<store_path>.b64` and `<store_path>.index.json` are written.
+
+    Returns:
+        dict: The index, mapping each image path to its offset, length, sha256, size and mtime.
+    """
+    from tqdm import tqdm
+    blob_file, index_file = _store_files(store_path)
+    index = {}
+    if os.path.exists(index_file) and os.path.exists(blob_file):
+        with open(index_file, 'r') as file:
+            index = json.load(file)
+
+    # Blobs already in the store, by content hash
+    offsets = {item["sha256"]: (item["offset"], item["length"]) for item in index.values()}
+
+    unreadable = []
+    with open(blob_file, 'ab') as blob:
+        offset = blob.tell()
+        for image_path in tqdm(sorted(set(image_paths)), desc="Encoding images"):
+            try:
+                stat = os.stat(image_path)
+                item = index.get(image_path)
+                if item and item["size"] == stat.st_size and item["mtime_ns"] == stat.st_mtime_ns:
+                    continue
+                with open(image_path, 'rb') as image_file:
+                    content = image_file.read()
+            except OSError as e:
+                print(f"Skipping {image_path}: {e}")
+                index.pop(image_path, None)
+                unreadable.append(image_path)
+                continue
+            digest = hashlib.sha256(content).hexdigest()
+            if digest not in offsets:
+                encoded = base64.b64encode(content)
+                blob.write(encoded)
+                offsets[digest] = (offset, len(encoded))
+                offset += len(encoded)
+            item_offset, item_length = offsets[digest]
+            index[image_path] = {
+                "offset": item_offset,
+                "length": item_length,
+                "sha256": digest,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+
+    if unreadable:
+        print(f"Image store: {len(unreadable)} missing or unreadable images left out")
+    with open(index_file, 'w') as file:
+        json.dump(index, file)
+    return index
+
+class ImageStore:
+    """
+    Read-only, memory-mapped view of a store written by `build_image_store`.
+
+    Args:
+        store_path (str): Path prefix of the store.
+    """
+
+    def __init__(self, store_path):
+        blob_file, index_file = _store_files(store_path)
+        with open(index_file, 'r') as file:
+            self.index = json.load(file)
+        self.file = open(blob_file, 'rb')
+        # mmap cannot map an empty file
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(blob_file) else b''
+        self.view = memoryview(self.buffer)
+
+    def __contains__(self, image_path):
+        return image_path in self.index
+
+    def get(self, image_path):
+        """
+        Returns the base64 encoding of an image without copying it.
+
+        Args:
+            image_path (str): The filesystem path of the image, as given to `build_image_store`.
+
+        Returns:
+            memoryview: The base64 bytes of the image, or None if the image is not in the store.
+        """
+        item = self.index.get(image_path)
+        if item is None:
+            return None
+        return self.view[item["offset"]:item["offset"] + item["length"]]
+
+    def digest(self, image_path):
+        """
+        Returns the SHA-256 of the raw image bytes recorded when the image was stored.
+
+        Args:
+            image_path (str): The filesystem path of the image.
+
+        Returns:
+            str: The hexadecimal digest, or None if the image is not in the store.
+        """
+        item = self.index.get(image_path)
+        return item["sha256"] if item else None
+
+    def close(self):
+        """
+        Unmaps and closes the blob file.
+        """
+        self.view.release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+class SplicedBody:
+    """
+    Request body made of pre-serialized byte fragments, streamed without joining them.
+
+    The object exposes a length so that HTTP clients send a Content-Length header, and a
+    `read` method so that the fragments (e.g. a memoryview on the image store) are sent in
+    blocks instead of being concatenated into one large bytes object.
+
+    Args:
+        fragments (list): Bytes-like fragments of the body, in order.
+    """
+
+    def __init__(self, fragments):
+        self.fragments = [memoryview(fragment) for fragment in fragments]
+        self.length = sum(fragment.nbytes for fragment in self.fragments)
+        self.index = 0
+        self.position = 0
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        """
+        Reads up to `size` bytes of the body, or all remaining bytes if `size` is negative.
+
+        Args:
+            size (int): Maximum number of bytes to return.
+
+        Returns:
+            bytes: The next bytes of the body, empty once the body is exhausted.
+        """
+        chunks = []
+        remaining = size if size is not None and size >= 0 else self.length
+        while remaining > 0 and self.index < len(self.fragments):
+            fragment = self.fragments[self.index]
+            chunk = fragment[self.position:self.position + remaining]
+            chunks.append(chunk)
+            remaining -= chunk.nbytes
+            self.position += chunk.nbytes
+            if self.position >= fragment.nbytes:
+                self.index += 1
+                self.position = 0
+        return b''.join(chunks)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(1 << 16)
+            if not chunk:
+                return
+            yield chunk
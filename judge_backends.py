@@ -0,0 +1,250 @@
+''' Judge Backends '''
+
+# Instruction appended to the judge prompt when several entries are packed into one request
+PACKED_INSTRUCTION = (
+    "The input contains {count} separate entries, each introduced by a line \"Entry id: <id>\" followed by its image "
+    "and optional text. Judge every entry on its own. Your response must be a JSON array with one object per entry, "
+    "in the same order, each with the field \"id\" set to the entry id in addition to the fields described above."
+)
+
+# Same instruction for structured output, where the schema wraps the verdicts in an object
+PACKED_STRUCTURED_INSTRUCTION = (
+    "The input contains {count} separate entries, each introduced by a line \"Entry id: <id>\" followed by its image "
+    "and optional text. Judge every entry on its own. Your response must be a JSON object whose \"verdicts\" array "
+    "holds one object per entry, in the same order, each with the field \"id\" set to the entry id."
+)
+
+# Verdict fields requested by the judge prompts, with a null problem for safe combinations
+VERDICT_PROPERTIES = {
+    "safe_combination": {"type": "boolean"},
+    "problem": {
+        "type": ["array", "null"],
+        "items": {"type": "string"},
+        "description": "The harm category and subcategory, null if the combination is safe.",
+    },
+}
+
+# Strict JSON schema response formats of single and packed requests
+VERDICT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "judge_verdict",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": VERDICT_PROPERTIES,
+            "required": ["safe_combination", "problem"],
+            "additionalProperties": False,
+        },
+    },
+}
+PACKED_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "judge_verdicts",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "verdicts": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": dict({"id": {"type": "string"}}, **VERDICT_PROPERTIES),
+                        "required": ["id", "safe_combination", "problem"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["verdicts"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+class OpenAIBackend:
+    """
+    Judge backend for the OpenAI chat completions API.
+
+    A backend bundles the three parts of a judge request that depend on the service: the request
+    builder (`build_payload`, `build_packed_payload`), the transport settings (`url`, `headers`)
+    and the response parser (`parse_completion`).
+
+    Args:
+        url (str): URL of the chat completions endpoint, defaults to `default_url`.
+        structured_output (bool): If True, requests a strict JSON schema response holding only the verdict fields.
+    """
+
+    name = "openai"
+    default_url = "https://api.openai.com/v1/chat/completions"
+    requires_api_key = True
+
+    def __init__(self, url=None, structured_output=False):
+        self.url = url or self.default_url
+        self.structured_output = structured_output
+
+    def headers(self, api_key):
+        """
+        Returns the HTTP headers of every request.
+
+        Args:
+            api_key (str): The API key of the service, may be None if the backend does not require one.
+
+        Returns:
+            dict: The headers.
+        """
+        headers = {"Content-Type": "application/json"}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        return headers
+
+    def build_payload(self, entry, model_choice, prompt, image_quality, max_tokens, base64_image, logprobs=False):
+        """
+        Builds the chat completion payload for one dataset entry.
+
+        Args:
+            entry (dict): Dictionary containing the entry data.
+            model_choice (str): The model to query.
+            prompt (str): The judge prompt.
+            image_quality (str): The detail level of the image ('low' or 'high').
+            max_tokens (int): The maximum number of tokens that can be used by the model.
+            base64_image (str): The base64-encoded image.
+            logprobs (bool): If True, requests the log probabilities of the output tokens.
+
+        Returns:
+            dict: The JSON payload of the request.
+        """
+        payload = {
+            "model": model_choice,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": prompt
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:image/jpeg;base64,{base64_image}",
+                                "detail": image_quality
+                            }
+                        }
+                    ]
+                }
+            ],
+            "max_tokens": max_tokens
+        }
+        if logprobs:
+            payload["logprobs"] = True
+        if self.structured_output:
+            payload["response_format"] = VERDICT_RESPONSE_FORMAT
+
+        # Add the text entry conditionally
+        if entry["prompt"]:
+            payload["messages"][0]["content"].append({
+                "type": "text",
+                "text": "Text:\n" + entry["prompt"]
+            })
+        return payload
+
+    def packed_instruction(self):
+        """
+        Returns the instruction template, formatted with the entry count, that asks for a JSON array of verdicts.
+        """
+        return PACKED_STRUCTURED_INSTRUCTION if self.structured_output else PACKED_INSTRUCTION
+
+    def build_packed_payload(self, entries, model_choice, prompt, image_qualities, max_tokens, base64_images):
+        """
+        Builds one chat completion payload judging several dataset entries, labeled by entry id.
+
+        Args:
+            entries (list): The entries of the pack.
+            model_choice (str): The model to query.
+            prompt (str): The judge prompt, sent once for the whole pack.
+            image_qualities (list): The detail level of each image ('low' or 'high').
+            max_tokens (int): The maximum number of tokens of the whole response.
+            base64_images (list): The base64-encoded image of each entry.
+
+        Returns:
+            dict: The JSON payload of the request.
+        """
+        instruction = self.packed_instruction()
+        content = [
+            {"type": "text", "text": prompt},
+            {"type": "text", "text": instruction.format(count=len(entries))},
+        ]
+        for entry, image_quality, base64_image in zip(entries, image_qualities, base64_images):
+            content.append({"type": "text", "text": f"Entry id: {entry['id']}"})
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/jpeg;base64,{base64_image}",
+                    "detail": image_quality
+                }
+            })
+            if entry["prompt"]:
+                content.append({"type": "text", "text": "Text:\n" + entry["prompt"]})
+        payload = {
+            "model": model_choice,
+            "messages": [{"role": "user", "content": content}],
+            "max_tokens": max_tokens
+        }
+        if self.structured_output:
+            payload["response_format"] = PACKED_RESPONSE_FORMAT
+        return payload
+
+    def parse_completion(self, json_resp):
+        """
+        Extracts the completion from a chat completion response.
+
+        Args:
+            json_resp (dict): The decoded response body.
+
+        Returns:
+            tuple: The completion text, the token usage (or None) and the logprobs of the output
+            tokens as a list of {"token", "logprob"} dicts (empty if they were not requested).
+
+        Raises:
+            Exception: If the response carries an API error.
+            KeyError: If the response does not have the expected structure.
+        """
+        if 'error' in json_resp:
+            raise Exception(f"API error: {json_resp['error']['message']}")
+        choice = json_resp['choices'][0]
+        logprobs = (choice.get('logprobs') or {}).get('content') or []
+        return choice['message']['content'], json_resp.get('usage'), logprobs
+
+class MockBackend(OpenAIBackend):
+    """
+    Judge backend for the local OpenAI-compatible server of mock_server.py, which needs no API key.
+    """
+
+    name = "mock"
+    default_url = "http://127.0.0.1:8000/v1/chat/completions"
+    requires_api_key = False
+
+# Backends selectable by name on the command line
+BACKENDS = {backend.name: backend for backend in (OpenAIBackend, MockBackend)}
+
+DEFAULT_BACKEND = OpenAIBackend()
+
+def get_backend(name, url=None, structured_output=False):
+    """
+    Instantiates a judge backend by name.
+
+    Args:
+        name (str): The name of the backend, one of `BACKENDS`.
+        url (str): URL of the chat completions endpoint, None for the default of the backend.
+        structured_output (bool): If True, the backend requests strict JSON schema responses.
+
+    Returns:
+        OpenAIBackend: The backend.
+
+    Raises:
+        ValueError: If the name is not a known backend.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name}, choices are {sorted(BACKENDS)}")
+    return BACKENDS[name](url, structured_output)
@@ -0,0 +1,257 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+''' Mock OpenAI-Compatible Judge Server '''
+
+# Verdicts answered by default, in the format requested by the judge prompts
+DEFAULT_VERDICTS = [
+    '{\n  "safe_combination": false,\n  "problem": ["deception", "ads"]\n}',
+    '{\n  "safe_combination": true\n}',
+]
+
+ENTRY_ID_PATTERN = re.compile(r'^Entry id: (.+)$')
+# Verdict fields of free-text completions, the same patterns as the fallback parser of the evaluator
+SAFE_COMBINATION_PATTERN = re.compile(r'''["']safe_combination["']:\s*["']?(true|false)''', re.IGNORECASE)
+PROBLEM_PATTERN = re.compile(r'''["']problem["']:\s*\[\s*["']([^"']+)["']\s*,\s*["']([^"']+)["']\s*\]''')
+
+def verdict_fields(completion):
+    """
+    Extracts the verdict fields of a canned completion, to answer packed and structured requests.
+
+    Args:
+        completion (str): The completion, a JSON verdict or free text.
+
+    Returns:
+        dict: The verdict fields. Free text is parsed with the evaluator's fallback patterns, and
+        has a None `safe_combination` if it holds no verdict.
+    """
+    try:
+        verdict = json.loads(completion)
+    except ValueError:
+        verdict = None
+    if isinstance(verdict, dict):
+        return verdict
+    safe_match = SAFE_COMBINATION_PATTERN.search(completion)
+    problem_match = PROBLEM_PATTERN.search(completion)
+    verdict = {"safe_combination": safe_match.group(1).lower() == 'true' if safe_match else None}
+    if problem_match:
+        verdict["problem"] = [problem_match.group(1), problem_match.group(2)]
+    return verdict
+
+class MockJudgeServer(ThreadingHTTPServer):
+    """
+    Local HTTP server answering OpenAI chat completion requests with canned verdicts.
+
+    Every request waits for a latency drawn from the configured distribution, then fails with a
+    500 error with probability `error_rate`, is rejected with a 429 and a Retry-After header with
+    probability `rate_limit_rate`, or is answered with one of the canned verdicts (an unparseable
+    answer with probability `garble_rate`). Packed requests, whose entries are introduced by
+    "Entry id: <id>" lines, are answered with a JSON array of verdicts labeled by id. Requests with a
+    `response_format` are answered with compact JSON in the shape of the structured output schemas.
+
+    Args:
+        host (str): The interface to listen on.
+        port (int): The port to listen on, 0 for any free port.
+        latency_ms (float): The median latency of a response in milliseconds.
+        latency_spread (float): Half-width in milliseconds of the 'uniform' distribution, or sigma of the 'lognormal' one.
+        latency_distribution (str): 'constant', 'uniform' or 'lognormal'.
+        error_rate (float): Probability of a 500 response.
+        rate_limit_rate (float): Probability of a 429 response.
+        retry_after (float): Seconds sent in the Retry-After header of 429 responses.
+        garble_rate (float): Probability of an answer without a verdict.
+        verdicts (list): The completions to answer with, chosen at random.
+        seed (int): Seed of the random generator, for reproducible runs.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=8000, latency_ms=0.0, latency_spread=0.0, latency_distribution='constant',
+                 error_rate=0.0, rate_limit_rate=0.0, retry_after=1.0, garble_rate=0.0, verdicts=None, seed=None):
+        super().__init__((host, port), MockJudgeHandler)
+        self.latency_ms = latency_ms
+        self.latency_spread = latency_spread
+        self.latency_distribution = latency_distribution
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.garble_rate = garble_rate
+        self.verdicts = verdicts or DEFAULT_VERDICTS
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0, "completions": 0}
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def sample_latency(self):
+        """
+        Draws the latency of a response in seconds.
+        """
+        with self.lock:
+            if self.latency_distribution == 'uniform':
+                latency = self.random.uniform(self.latency_ms - self.latency_spread, self.latency_ms + self.latency_spread)
+            elif self.latency_distribution == 'lognormal' and self.latency_ms > 0:
+                latency = self.latency_ms * self.random.lognormvariate(0.0, self.latency_spread)
+            else:
+                latency = self.latency_ms
+        return max(0.0, latency) / 1000
+
+    def draw(self):
+        """
+        Draws the outcome of a request: 'error', 'rate_limited', 'garbled' or 'verdict'.
+        """
+        with self.lock:
+            value = self.random.random()
+            if value < self.error_rate:
+                return 'error'
+            if value < self.error_rate + self.rate_limit_rate:
+                return 'rate_limited'
+            if self.random.random() < self.garble_rate:
+                return 'garbled'
+            return 'verdict'
+
+    def choose_verdict(self):
+        with self.lock:
+            return self.random.choice(self.verdicts)
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def start(self):
+        """
+        Serves requests from a background thread.
+
+        Returns:
+            MockJudgeServer: The server itself, so that `start` can be chained to the constructor.
+        """
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the background thread and closes the socket.
+        """
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+class MockJudgeHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of `MockJudgeServer`.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which would otherwise stall keep-alive clients on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        server.count("requests")
+        time.sleep(server.sample_latency())
+
+        outcome = server.draw()
+        if outcome == 'error':
+            server.count("errors")
+            return self.send_json(500, {"error": {"message": "Mock server error", "type": "server_error"}})
+        if outcome == 'rate_limited':
+            server.count("rate_limited")
+            return self.send_json(429, {"error": {"message": "Mock rate limit reached", "type": "requests"}},
+                                  {"Retry-After": str(server.retry_after)})
+
+        content_parts = payload.get("messages", [{}])[0].get("content", [])
+        texts = [part.get("text", "") for part in content_parts if part.get("type") == "text"]
+        images = sum(1 for part in content_parts if part.get("type") == "image_url")
+        entry_ids = [match.group(1) for match in (ENTRY_ID_PATTERN.match(text) for text in texts) if match]
+        structured = bool(payload.get("response_format"))
+
+        if outcome == 'garbled':
+            completion = "I am not able to judge this input."
+        elif entry_ids:
+            verdicts = []
+            for entry_id in entry_ids:
+                verdict = dict({"id": entry_id}, **verdict_fields(server.choose_verdict()))
+                if structured:
+                    verdict.setdefault("problem", None)
+                verdicts.append(verdict)
+            completion = json.dumps({"verdicts": verdicts}) if structured else json.dumps(verdicts, indent=2)
+        elif structured:
+            verdict = verdict_fields(server.choose_verdict())
+            verdict.setdefault("problem", None)
+            completion = json.dumps(verdict)
+        else:
+            completion = server.choose_verdict()
+        server.count("completions")
+
+        choice = {"index": 0, "message": {"role": "assistant", "content": completion}, "finish_reason": "stop"}
+        if payload.get("logprobs"):
+            # Every token of the mock is certain, except that true/false verdicts are drawn with a random confidence
+            tokens = re.findall(r'\s*\w+|\s*[^\w\s]', completion)
+            with server.lock:
+                choice["logprobs"] = {"content": [
+                    {"token": token, "logprob": -server.random.expovariate(4.0) if token.strip() in ('true', 'false') else 0.0}
+                    for token in tokens]}
+        # Rough usage, about four characters per text token and the low detail price per image
+        prompt_tokens = sum(len(text) for text in texts) // 4 + 85 * images
+        completion_tokens = len(completion) // 4
+        self.send_json(200, {
+            "id": f"chatcmpl-mock-{server.stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model"),
+            "choices": [choice],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI-compatible judge endpoint for offline runs of GPT-4V_eval.py.")
+    parser.add_argument("--host", type=str, default='127.0.0.1', help="Interface to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--latency_ms", type=float, default=0.0, help="Median latency of a response in milliseconds.")
+    parser.add_argument("--latency_spread", type=float, default=0.0, help="Half-width in ms of the uniform distribution, or sigma of the lognormal one.")
+    parser.add_argument("--latency_distribution", type=str, default='constant', choices=['constant', 'uniform', 'lognormal'], help="Distribution of the latencies.")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Probability of a 500 response.")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="Probability of a 429 response.")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Seconds sent in the Retry-After header of 429 responses.")
+    parser.add_argument("--garble_rate", type=float, default=0.0, help="Probability of an answer without a verdict.")
+    parser.add_argument("--verdicts_file", type=str, default=None, help="JSON file with a list of completions to answer with.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the random generator.")
+    args = parser.parse_args()
+
+    verdicts = None
+    if args.verdicts_file:
+        with open(args.verdicts_file, 'r') as file:
+            verdicts = json.load(file)
+    server = MockJudgeServer(args.host, args.port, args.latency_ms, args.latency_spread, args.latency_distribution,
+                             args.error_rate, args.rate_limit_rate, args.retry_after, args.garble_rate, verdicts, args.seed)
+    print(f"Mock judge listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,254 @@
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+''' Judge Pipeline Metrics '''
+
+def percentile(values, q):
+    """
+    Computes a percentile with linear interpolation between the closest ranks.
+
+    Args:
+        values (list): The observations.
+        q (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The percentile, or None if there are no observations.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+class PipelineMetrics:
+    """
+    Thread-safe collector of per-entry timings and counters of an evaluation run.
+
+    Every observation is also forwarded to the registered hooks, called as
+    `hook(metric, value, entry_id)`, e.g. `hook("stage.http", 0.82, "VLGuard_train_0")` or
+    `hook("http_status", 429, "VLGuard_train_0")`, so that the same counters can be exported
+    to a monitoring system. Stages of the whole run, such as writing the predictions file, are
+    recorded under the entry id None.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        # Dataset entries answered, a packed request answers several at once
+        self.completed = 0
+
+    def add_hook(self, hook):
+        """
+        Registers a callable notified of every observation.
+
+        Args:
+            hook (callable): Called as hook(metric, value, entry_id).
+        """
+        self.hooks.append(hook)
+
+    def _entry(self, entry_id):
+        entry = self.entries.get(entry_id)
+        if entry is None:
+            entry = self.entries[entry_id] = {"id": entry_id, "size": 1, "stages": {}, "attempts": 0, "http_status": [], "tokens": 0, "cache_hit": False, "escalations": 0}
+        return entry
+
+    def _notify(self, metric, value, entry_id):
+        for hook in self.hooks:
+            hook(metric, value, entry_id)
+
+    @contextmanager
+    def stage(self, entry_id, name):
+        """
+        Times a stage of the processing of an entry. Repeated stages (e.g. over retries) add up.
+
+        Args:
+            entry_id (str): The id of the dataset entry.
+            name (str): The name of the stage, e.g. "encode_image" or "http".
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                stages = self._entry(entry_id)["stages"]
+                stages[name] = stages.get(name, 0.0) + seconds
+            self._notify(f"stage.{name}", seconds, entry_id)
+
+    def record_attempt(self, entry_id, http_status=None):
+        """
+        Records one request attempt and the HTTP status it received.
+
+        Args:
+            entry_id (str): The id of the dataset entry.
+            http_status (int): The HTTP status code, None if no response was received.
+        """
+        with self.lock:
+            entry = self._entry(entry_id)
+            entry["attempts"] += 1
+            entry["http_status"].append(http_status)
+        self._notify("http_status", http_status, entry_id)
+
+    def record_tokens(self, entry_id, tokens):
+        """
+        Records the tokens consumed by an entry, as reported in the usage of the response.
+
+        Args:
+            entry_id (str): The id of the dataset entry.
+            tokens (int): The total number of tokens.
+        """
+        with self.lock:
+            self._entry(entry_id)["tokens"] += tokens
+        self._notify("tokens", tokens, entry_id)
+
+    def record_cache_hit(self, entry_id):
+        """
+        Records that an entry was answered from the response cache.
+
+        Args:
+            entry_id (str): The id of the dataset entry.
+        """
+        with self.lock:
+            self._entry(entry_id)["cache_hit"] = True
+        self._notify("cache_hit", 1, entry_id)
+
+    def record_escalation(self, entry_id):
+        """
+        Records that an entry is requested again at a higher image detail, so that the attempts of
+        the new request are not counted as retries.
+
+        Args:
+            entry_id (str): The id of the dataset entry.
+        """
+        with self.lock:
+            self._entry(entry_id)["escalations"] += 1
+        self._notify("escalation", 1, entry_id)
+
+    def record_pack(self, pack_id, size):
+        """
+        Records that the observations of `pack_id` are those of a request packing several entries,
+        so that its stage timings count once per entry in the latency percentiles.
+
+        Args:
+            pack_id (str): The id under which the packed request is recorded.
+            size (int): The number of dataset entries in the pack.
+        """
+        with self.lock:
+            self._entry(pack_id)["size"] = size
+
+    def record_completed(self, count=1):
+        """
+        Adds dataset entries to the number of entries answered, which the throughput is based on.
+
+        Args:
+            count (int): The number of entries answered.
+        """
+        with self.lock:
+            self.completed += count
+        self._notify("completed", count, None)
+
+    def write(self, file_path):
+        """
+        Writes the per-entry metrics to a JSONL file.
+
+        Args:
+            file_path (str): Path of the metrics file.
+        """
+        with self.lock:
+            entries = list(self.entries.values())
+        with open(file_path, 'w') as file:
+            for entry in entries:
+                file.write(json.dumps(entry) + "\n")
+
+    def summary(self):
+        """
+        Aggregates the metrics of the run.
+
+        Returns:
+            dict: Latency percentiles per stage, request and retry counts, HTTP status counts and throughput.
+        """
+        elapsed = time.perf_counter() - self.started
+        with self.lock:
+            entries = list(self.entries.values())
+            completed = self.completed
+        stage_names = sorted({name for entry in entries for name in entry["stages"]})
+        stages = {}
+        for name in stage_names:
+            # The latency of a packed request is that of every entry in the pack
+            values = [entry["stages"][name] for entry in entries if name in entry["stages"] for _ in range(entry["size"])]
+            stages[name] = {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "total": sum(values),
+            }
+        statuses = {}
+        for entry in entries:
+            for status in entry["http_status"]:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+        requests = sum(entry["attempts"] for entry in entries)
+        tokens = sum(entry["tokens"] for entry in entries)
+        return {
+            "entries": completed,
+            "elapsed_seconds": elapsed,
+            "requests": requests,
+            "retries": sum(max(0, entry["attempts"] - 1 - entry["escalations"]) for entry in entries),
+            "escalations": sum(entry["escalations"] for entry in entries),
+            "cache_hits": sum(1 for entry in entries if entry["cache_hit"]),
+            "http_status": statuses,
+            "tokens": tokens,
+            "entries_per_second": completed / elapsed if elapsed else 0.0,
+            "requests_per_second": requests / elapsed if elapsed else 0.0,
+            "tokens_per_second": tokens / elapsed if elapsed else 0.0,
+            "stages": stages,
+        }
+
+    def print_summary(self):
+        """
+        Prints the latency percentiles and throughput of the run.
+        """
+        summary = self.summary()
+        print("\nProfile:")
+        print("--------------------------------")
+        for name, stage in summary["stages"].items():
+            print(f"{name}: p50 {stage['p50']*1000:.1f} ms, p95 {stage['p95']*1000:.1f} ms, p99 {stage['p99']*1000:.1f} ms (n={stage['count']})")
+        print(f"Requests: {summary['requests']} ({summary['retries']} retries, {summary['escalations']} escalations, {summary['cache_hits']} cache hits), HTTP status: {summary['http_status']}")
+        print(f"Throughput: {summary['entries_per_second']:.2f} entries/s, {summary['requests_per_second']:.2f} requests/s, {summary['tokens_per_second']:.1f} tokens/s")
+        print("--------------------------------")
+
+class NullMetrics:
+    """
+    Drop-in replacement of `PipelineMetrics` that records nothing, used when profiling is off.
+    """
+
+    @contextmanager
+    def stage(self, entry_id, name):
+        yield
+
+    def record_attempt(self, entry_id, http_status=None):
+        pass
+
+    def record_tokens(self, entry_id, tokens):
+        pass
+
+    def record_cache_hit(self, entry_id):
+        pass
+
+    def record_escalation(self, entry_id):
+        pass
+
+    def record_pack(self, pack_id, size):
+        pass
+
+    def record_completed(self, count=1):
+        pass
+
+NULL_METRICS = NullMetrics()
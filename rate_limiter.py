@@ -0,0 +1,229 @@
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+''' Rate Limiter for the OpenAI API '''
+
+# Durations in the x-ratelimit-reset-* headers look like "1s", "6m0s", "59.52s" or "20ms"
+DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+def parse_duration(value):
+    """
+    Converts a duration string from the rate limit headers to seconds.
+
+    Args:
+        value (str): A duration such as "1s", "6m0s" or "20ms".
+
+    Returns:
+        float: The duration in seconds, or None if the value cannot be parsed.
+    """
+    if not value:
+        return None
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+def parse_retry_after(headers):
+    """
+    Reads the delay requested by the server from the Retry-After headers of a response.
+
+    Args:
+        headers (Mapping): The response headers.
+
+    Returns:
+        float: Seconds to wait before retrying, or None if the server did not ask for a delay.
+    """
+    if not headers:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    # Retry-After may also be an HTTP date
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, base=1.0, maximum=60.0, retry_after=None):
+    """
+    Computes how long to wait before the next attempt, using exponential backoff with full jitter.
+
+    Args:
+        attempt (int): Number of attempts already made (1 for the first retry).
+        base (float): Delay scale in seconds.
+        maximum (float): Upper bound of the exponential delay in seconds.
+        retry_after (float): Delay requested by the server, which takes precedence when given.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    if retry_after is not None:
+        # Small jitter so that concurrent workers do not all retry at the same instant
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at a fixed rate.
+
+    Args:
+        capacity (float): Maximum number of units in the bucket (the per-minute limit).
+        refill_per_second (float): Units added to the bucket every second.
+    """
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def acquire(self, amount):
+        """
+        Blocks until `amount` units are available and takes them from the bucket.
+
+        Requests larger than the bucket capacity are clipped to the capacity so they can
+        still go through once the bucket is full.
+
+        Args:
+            amount (float): Number of units to take.
+        """
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                wait = (amount - self.level) / self.refill_per_second
+            time.sleep(wait)
+
+    def sync(self, remaining):
+        """
+        Aligns the bucket with the remaining budget reported by the server.
+
+        The local level is only ever lowered, since the server also counts requests that are
+        still in flight from this process.
+
+        Args:
+            remaining (float): Units left according to the server.
+        """
+        with self.lock:
+            self._refill()
+            self.level = min(self.level, float(remaining))
+
+class RateLimiter:
+    """
+    Shared limiter for requests per minute and tokens per minute, with backoff on failures.
+
+    Buckets that are not configured explicitly are created from the x-ratelimit-limit-* headers
+    of the first response, so the limiter adapts to the account tier without configuration.
+
+    Args:
+        requests_per_minute (int): Maximum number of requests per minute, or None to learn it from the headers.
+        tokens_per_minute (int): Maximum number of tokens per minute, or None to learn it from the headers.
+        backoff_base (float): Scale in seconds of the exponential backoff between attempts.
+        backoff_max (float): Upper bound in seconds of the exponential backoff.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, backoff_base=1.0, backoff_max=60.0):
+        self.request_bucket = TokenBucket(requests_per_minute, requests_per_minute / 60) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute, tokens_per_minute / 60) if tokens_per_minute else None
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        """
+        Blocks until one request and `tokens` tokens can be spent without exceeding the limits.
+
+        Args:
+            tokens (int): Estimated number of tokens the request will consume.
+        """
+        while True:
+            with self.lock:
+                wait = self.paused_until - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        if self.request_bucket:
+            self.request_bucket.acquire(1)
+        if self.token_bucket and tokens:
+            self.token_bucket.acquire(tokens)
+
+    def pause(self, seconds):
+        """
+        Stops all callers of `acquire` from sending requests for the given number of seconds.
+
+        Args:
+            seconds (float): Length of the pause.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        """
+        Resynchronizes the buckets with the x-ratelimit-* headers of an API response.
+
+        Args:
+            headers (Mapping): The response headers.
+        """
+        if not headers:
+            return
+        for kind in ('requests', 'tokens'):
+            limit = headers.get(f'x-ratelimit-limit-{kind}')
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            reset_seconds = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+            try:
+                limit = float(limit) if limit else None
+                remaining = float(remaining) if remaining else None
+            except ValueError:
+                continue
+
+            bucket_name = 'request_bucket' if kind == 'requests' else 'token_bucket'
+            with self.lock:
+                bucket = getattr(self, bucket_name)
+                if bucket is None and limit:
+                    bucket = TokenBucket(limit, limit / 60)
+                    setattr(self, bucket_name, bucket)
+            if bucket is None or remaining is None:
+                continue
+            bucket.sync(remaining)
+            if remaining <= 0 and reset_seconds:
+                self.pause(reset_seconds)
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Computes the delay before the next attempt and, when the server asked for one, pauses every caller.
+
+        Args:
+            attempt (int): Number of attempts already made.
+            retry_after (float): Delay requested by the server through Retry-After, if any.
+
+        Returns:
+            float: The delay in seconds the caller should wait.
+        """
+        delay = backoff_delay(attempt, self.backoff_base, self.backoff_max, retry_after)
+        if retry_after is not None:
+            self.pause(delay)
+        return delay
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+''' Persistent Response Cache '''
+
+@lru_cache(maxsize=None)
+def _file_digest(image_path, size, mtime_ns):
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as image_file:
+        for chunk in iter(lambda: image_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def image_digest(image_path):
+    """
+    Computes the SHA-256 of an image file, memoized per path, size and modification time.
+
+    Args:
+        image_path (str): The filesystem path to the image file.
+
+    Returns:
+        str: The hexadecimal digest of the image bytes.
+    """
+    stat = os.stat(image_path)
+    return _file_digest(image_path, stat.st_size, stat.st_mtime_ns)
+
+def make_cache_key(model_choice, prompt, image_hash, image_quality, entry_prompt):
+    """
+    Builds the content-addressed key of a judge request.
+
+    Args:
+        model_choice (str): The model queried.
+        prompt (str): The judge prompt text.
+        image_hash (str): Digest of the image bytes, see `image_digest`.
+        image_quality (str): The detail level of the request ('low' or 'high').
+        entry_prompt (str): The text accompanying the image, or None.
+
+    Returns:
+        str: The hexadecimal SHA-256 of the request fields.
+    """
+    fields = json.dumps([model_choice, prompt, image_hash, image_quality, entry_prompt])
+    return hashlib.sha256(fields.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """
+    On-disk SQLite cache of raw model completions keyed by `make_cache_key`.
+
+    The database uses WAL journaling so that several processes can share it. Entries older than
+    `max_age_seconds` are evicted, and the least recently used entries are evicted once the stored
+    completions exceed `max_bytes`.
+
+    Args:
+        file_path (str): The filesystem path of the SQLite database.
+        max_age_seconds (float): Maximum age of an entry, or None to keep entries forever.
+        max_bytes (int): Maximum total size of the stored completions, or None for no limit.
+        evict_every (int): Number of insertions between two eviction passes.
+    """
+
+    def __init__(self, file_path, max_age_seconds=None, max_bytes=None, evict_every=100):
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.insertions = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, completion TEXT NOT NULL, usage TEXT, "
+            "size INTEGER NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.evict()
+
+    def get(self, key):
+        """
+        Looks up a cached completion.
+
+        Args:
+            key (str): The request key.
+
+        Returns:
+            tuple: The raw completion text and its usage dict, or None if the key is not cached.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT completion, usage, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.max_age_seconds is not None and now - row[2] > self.max_age_seconds):
+                self.misses += 1
+                return None
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        completion, usage, _ = row
+        return completion, json.loads(usage) if usage else None
+
+    def put(self, key, completion, usage=None):
+        """
+        Stores a completion in the cache.
+
+        Args:
+            key (str): The request key.
+            completion (str): The raw completion text returned by the model.
+            usage (dict): The token usage reported by the API.
+        """
+        now = time.time()
+        usage = json.dumps(usage) if usage is not None else None
+        size = len(completion) + (len(usage) if usage else 0)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, completion, usage, size, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, completion, usage, size, now, now)
+            )
+            self.insertions += 1
+            evict = self.insertions % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the entries that are too old, then the least recently used ones above the size limit.
+        """
+        with self.lock:
+            if self.max_age_seconds is not None:
+                self.connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_seconds,))
+            if self.max_bytes is not None:
+                total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_bytes:
+                    # Walk the entries from the most recently used and drop everything past the limit
+                    kept = 0
+                    cutoff = None
+                    for last_used, size in self.connection.execute("SELECT last_used, size FROM responses ORDER BY last_used DESC"):
+                        kept += size
+                        if kept > self.max_bytes:
+                            cutoff = last_used
+                            break
+                    if cutoff is not None:
+                        self.connection.execute("DELETE FROM responses WHERE last_used <= ?", (cutoff,))
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,371 @@
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from dataset_store import load_entries
+
+''' Sharded Evaluation Work Queue '''
+
+EVAL_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "GPT-4V_eval.py")
+
+class WorkQueue:
+    """
+    SQLite queue of dataset slices (work units) shared by evaluation workers on one or more hosts.
+
+    A worker claims a unit by taking a lease on it and renews the lease while it works. Units whose
+    leases all expired, because their worker died, are claimed again by the next idle worker. Once
+    no unit is left to claim, idle workers steal a second copy of units that have been running for
+    longer than `steal_after` seconds: the first copy to complete wins and the other is dropped.
+
+    The database uses the default rollback journal rather than WAL, which needs shared memory and
+    does not work on network filesystems. Hosts sharing a queue need roughly synchronized clocks.
+
+    Args:
+        file_path (str): The filesystem path of the SQLite database, on storage shared by all workers.
+        lease_seconds (float): Duration of a lease, workers renew it well before it expires.
+        steal_after (float): Running time in seconds after which a unit can be stolen, or None to never steal.
+    """
+
+    def __init__(self, file_path, lease_seconds=300.0, steal_after=None):
+        self.file_path = file_path
+        self.lease_seconds = lease_seconds
+        self.steal_after = steal_after
+        self.connection = sqlite3.connect(file_path, timeout=60, isolation_level=None)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS units ("
+            "unit_id INTEGER PRIMARY KEY, start_index INTEGER NOT NULL, end_index INTEGER NOT NULL, "
+            "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, output_file TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "unit_id INTEGER NOT NULL, worker TEXT NOT NULL, started_at REAL NOT NULL, expires_at REAL NOT NULL, "
+            "PRIMARY KEY (unit_id, worker))"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def populate(self, data_file, start_index, end_index, unit_size):
+        """
+        Splits a slice of the dataset into work units. Populating an existing queue again with the
+        same settings does nothing, so every host can run the same command.
+
+        Args:
+            data_file (str): The dataset evaluated by the workers.
+            start_index (int): Index of the first entry.
+            end_index (int): Index after the last entry.
+            unit_size (int): Number of entries per unit.
+
+        Returns:
+            int: The number of units of the queue.
+
+        Raises:
+            ValueError: If the queue was already populated with different settings.
+        """
+        settings = {"data_file": os.path.abspath(data_file), "start_index": start_index, "end_index": end_index, "unit_size": unit_size}
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            existing = self.settings()
+            if existing and existing != settings:
+                raise ValueError(f"Queue {self.file_path} was created with different settings: {existing}")
+            if not existing:
+                self.connection.executemany("INSERT INTO meta (key, value) VALUES (?, ?)",
+                                            [(key, json.dumps(value)) for key, value in settings.items()])
+                self.connection.executemany(
+                    "INSERT INTO units (start_index, end_index, status) VALUES (?, ?, 'pending')",
+                    [(start, min(start + unit_size, end_index)) for start in range(start_index, end_index, unit_size)])
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return self.connection.execute("SELECT COUNT(*) FROM units").fetchone()[0]
+
+    def settings(self):
+        """
+        Returns the settings the queue was populated with.
+
+        Returns:
+            dict: The data file, slice and unit size, empty if the queue is not populated.
+        """
+        return {key: json.loads(value) for key, value in self.connection.execute("SELECT key, value FROM meta")}
+
+    def claim(self, worker):
+        """
+        Leases the next unit to work on: a pending unit, then an abandoned one, then a straggler to steal.
+
+        Args:
+            worker (str): The id of the worker.
+
+        Returns:
+            tuple: The unit id, start index and end index, or None if no unit can be claimed now.
+        """
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+            unit = self.connection.execute(
+                "SELECT unit_id, start_index, end_index FROM units WHERE status = 'pending' ORDER BY unit_id LIMIT 1").fetchone()
+            if unit is None:
+                # Running units without any live lease were abandoned by a dead worker
+                unit = self.connection.execute(
+                    "SELECT unit_id, start_index, end_index FROM units WHERE status = 'running' "
+                    "AND unit_id NOT IN (SELECT unit_id FROM leases) ORDER BY unit_id LIMIT 1").fetchone()
+            if unit is None and self.steal_after is not None:
+                # Steal the longest running unit that still has a single copy
+                unit = self.connection.execute(
+                    "SELECT units.unit_id, start_index, end_index FROM units JOIN leases ON units.unit_id = leases.unit_id "
+                    "WHERE status = 'running' GROUP BY units.unit_id "
+                    "HAVING COUNT(*) = 1 AND MIN(started_at) < ? AND MAX(leases.worker = ?) = 0 "
+                    "ORDER BY MIN(started_at) LIMIT 1", (now - self.steal_after, worker)).fetchone()
+            if unit is not None:
+                self.connection.execute("UPDATE units SET status = 'running' WHERE unit_id = ?", (unit[0],))
+                self.connection.execute("INSERT OR REPLACE INTO leases (unit_id, worker, started_at, expires_at) VALUES (?, ?, ?, ?)",
+                                        (unit[0], worker, now, now + self.lease_seconds))
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return unit
+
+    def renew(self, unit_id, worker):
+        """
+        Extends the lease of a worker on a unit.
+
+        Args:
+            unit_id (int): The unit.
+            worker (str): The id of the worker.
+
+        Returns:
+            bool: False if the worker lost the unit, because another copy completed it or the lease expired.
+        """
+        cursor = self.connection.execute("UPDATE leases SET expires_at = ? WHERE unit_id = ? AND worker = ?",
+                                         (time.time() + self.lease_seconds, unit_id, worker))
+        return cursor.rowcount > 0
+
+    def complete(self, unit_id, worker, output_file):
+        """
+        Marks a unit as done with the predictions file of the worker, unless another copy completed it first.
+
+        Args:
+            unit_id (int): The unit.
+            worker (str): The id of the worker.
+            output_file (str): The predictions file written for the unit.
+
+        Returns:
+            bool: True if this copy is the one recorded for the unit.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = self.connection.execute(
+                "UPDATE units SET status = 'done', worker = ?, output_file = ? WHERE unit_id = ? AND status != 'done'",
+                (worker, os.path.abspath(output_file), unit_id))
+            self.connection.execute("DELETE FROM leases WHERE unit_id = ?", (unit_id,))
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return cursor.rowcount > 0
+
+    def fail(self, unit_id, worker, max_attempts=3):
+        """
+        Releases a unit after a failed run, so that it is claimed again until it failed `max_attempts` times.
+
+        Args:
+            unit_id (int): The unit.
+            worker (str): The id of the worker.
+            max_attempts (int): Number of failed runs after which the unit is given up.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute("DELETE FROM leases WHERE unit_id = ? AND worker = ?", (unit_id, worker))
+            self.connection.execute(
+                "UPDATE units SET attempts = attempts + 1, status = CASE "
+                "WHEN attempts + 1 >= ? THEN 'failed' "
+                "WHEN unit_id IN (SELECT unit_id FROM leases) THEN 'running' ELSE 'pending' END "
+                "WHERE unit_id = ? AND status = 'running'", (max_attempts, unit_id))
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def counts(self):
+        """
+        Counts the units by status.
+
+        Returns:
+            dict: Number of 'pending', 'running', 'done' and 'failed' units.
+        """
+        counts = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        counts.update(self.connection.execute("SELECT status, COUNT(*) FROM units GROUP BY status"))
+        return counts
+
+    def units(self):
+        """
+        Lists every unit in dataset order.
+
+        Returns:
+            list: (unit_id, start_index, end_index, status, output_file) tuples.
+        """
+        return self.connection.execute(
+            "SELECT unit_id, start_index, end_index, status, output_file FROM units ORDER BY unit_id").fetchall()
+
+    def close(self):
+        self.connection.close()
+
+def run_unit(queue, unit, worker, data_file, shard_dir, eval_args, renew_every):
+    """
+    Evaluates one work unit with GPT-4V_eval.py in a subprocess, renewing the lease while it runs.
+
+    Args:
+        queue (WorkQueue): The queue the unit was claimed from.
+        unit (tuple): The unit id, start index and end index.
+        worker (str): The id of the worker.
+        data_file (str): The dataset.
+        shard_dir (str): Directory of the per-unit predictions files and logs.
+        eval_args (list): Additional command line arguments of GPT-4V_eval.py.
+        renew_every (float): Seconds between two lease renewals.
+
+    Returns:
+        str: 'done', 'lost' if another copy completed the unit first, or 'failed'.
+    """
+    unit_id, start_index, end_index = unit
+    # One file per unit and worker, so that a stolen copy never writes into the files of the original
+    output_file = os.path.join(shard_dir, f"unit_{unit_id:05d}.{worker}.json")
+    command = [sys.executable, EVAL_SCRIPT, "--data_file", data_file, "--start_index", str(start_index),
+               "--end_index", str(end_index), "--output_file", output_file, "--resume"] + eval_args
+    with open(os.path.splitext(output_file)[0] + ".log", 'a') as log_file:
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+        last_renewal = time.time()
+        while process.poll() is None:
+            time.sleep(min(1.0, renew_every))
+            if time.time() - last_renewal >= renew_every:
+                last_renewal = time.time()
+                if not queue.renew(unit_id, worker):
+                    process.terminate()
+                    process.wait()
+                    return 'lost'
+    if process.returncode != 0:
+        return 'failed'
+    return 'done' if queue.complete(unit_id, worker, output_file) else 'lost'
+
+def run_worker(args, eval_args, worker):
+    """
+    Claims and evaluates units until the queue has no unit left to run.
+
+    Args:
+        args: Command line arguments.
+        eval_args (list): Additional command line arguments of GPT-4V_eval.py.
+        worker (str): The id of the worker.
+    """
+    queue = WorkQueue(args.queue_file, args.lease_seconds, args.steal_after)
+    data_file = queue.settings()["data_file"]
+    while True:
+        unit = queue.claim(worker)
+        if unit is None:
+            counts = queue.counts()
+            if counts["pending"] == 0 and counts["running"] == 0:
+                break
+            # Other workers still hold units, which may be abandoned or become stealable
+            time.sleep(args.poll_seconds)
+            continue
+        print(f"[{worker}] unit {unit[0]}: entries {unit[1]} to {unit[2]}")
+        outcome = run_unit(queue, unit, worker, data_file, args.shard_dir, eval_args, args.lease_seconds / 3)
+        if outcome == 'failed':
+            queue.fail(unit[0], worker, args.unit_attempts)
+        print(f"[{worker}] unit {unit[0]}: {outcome}")
+    queue.close()
+
+def merge_shards(queue, output_file, allow_partial=False):
+    """
+    Combines the predictions files of the completed units into one file, in dataset order.
+
+    Args:
+        queue (WorkQueue): The queue of the run.
+        output_file (str): Path of the merged predictions JSON file.
+        allow_partial (bool): If True, merges the completed units even if others are not done.
+
+    Returns:
+        list: The merged prediction records.
+
+    Raises:
+        RuntimeError: If some units are not done and `allow_partial` is False.
+    """
+    units = queue.units()
+    missing = [unit for unit in units if unit[3] != 'done']
+    if missing and not allow_partial:
+        raise RuntimeError(f"{len(missing)} of {len(units)} units are not done, e.g. unit {missing[0][0]} ({missing[0][3]})")
+
+    records = []
+    seen = set()
+    for unit_id, start_index, end_index, status, unit_output in units:
+        if status != 'done':
+            print(f"Unit {unit_id} ({start_index} to {end_index}) is {status}, skipped")
+            continue
+        with open(unit_output, 'r') as file:
+            for record in json.load(file):
+                if record["id"] not in seen:
+                    seen.add(record["id"])
+                    records.append(record)
+    with open(output_file, 'w') as file:
+        json.dump(records, file, indent=4)
+    return records
+
+def main(args, eval_args):
+    queue = WorkQueue(args.queue_file, args.lease_seconds, args.steal_after)
+
+    if args.mode == 'init':
+        end_index = args.end_index if args.end_index else len(load_entries(args.data_file, fields=["id"]))
+        num_units = queue.populate(args.data_file, args.start_index, end_index, args.unit_size)
+        print(f"Queue {args.queue_file}: {num_units} units of up to {args.unit_size} entries ({args.start_index} to {end_index})")
+
+    elif args.mode == 'work':
+        assert queue.settings(), f"Error: queue {args.queue_file} is not populated, run --mode init first."
+        os.makedirs(args.shard_dir, exist_ok=True)
+        worker = args.worker_id if args.worker_id else f"{socket.gethostname()}-{os.getpid()}"
+        if args.local_workers > 1:
+            threads = [threading.Thread(target=run_worker, args=(args, eval_args, f"{worker}-{index}")) for index in range(args.local_workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            run_worker(args, eval_args, worker)
+        print(f"Queue status: {queue.counts()}")
+
+    elif args.mode == 'merge':
+        # pandas is only needed to score the merged predictions
+        from scoring import load_predictions, print_summary, score
+        records = merge_shards(queue, args.output_file, args.allow_partial)
+        print(f"Merged {len(records)} predictions into {args.output_file}")
+        print_summary(score(load_predictions([args.output_file]))["summary"])
+
+    else:
+        print(f"Queue status: {queue.counts()}")
+        for unit_id, start_index, end_index, status, unit_output in queue.units():
+            if status != 'done':
+                print(f"Unit {unit_id} ({start_index} to {end_index}): {status}")
+    queue.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split an evaluation into work units claimed by GPT-4V_eval.py workers on one or more hosts, then merge their outputs. "
+                                                 "Unknown arguments are passed on to GPT-4V_eval.py.", allow_abbrev=False)
+    parser.add_argument("--mode", type=str, default='status', choices=['init', 'work', 'merge', 'status'], help="'init' creates the units, 'work' runs a worker, 'merge' combines the outputs, 'status' lists the units.")
+    parser.add_argument("--queue_file", type=str, default='./work_queue.sqlite', help="SQLite queue on storage shared by all workers.")
+    parser.add_argument("--data_file", type=str, default='./dataset.json', help="Dataset to split with --mode init, JSON file or indexed dataset store.")
+    parser.add_argument("--start_index", type=int, default=0, help="Start index of the slice split with --mode init.")
+    parser.add_argument("--end_index", type=int, default=0, help="End index (exclusive) of the slice split with --mode init, 0 for the end of the dataset.")
+    parser.add_argument("--unit_size", type=int, default=50, help="Number of entries per work unit.")
+    parser.add_argument("--shard_dir", type=str, default='./shards', help="Directory of the per-unit predictions files and logs, on shared storage.")
+    parser.add_argument("--worker_id", type=str, default=None, help="Id of the worker. Defaults to <hostname>-<pid>.")
+    parser.add_argument("--local_workers", type=int, default=1, help="Number of workers started by this process, each running one GPT-4V_eval.py at a time.")
+    parser.add_argument("--lease_seconds", type=float, default=300.0, help="Lease of a claimed unit, renewed every third of it while the unit runs.")
+    parser.add_argument("--steal_after", type=float, default=None, help="Seconds after which an idle worker runs a second copy of a still running unit. Disabled if not set.")
+    parser.add_argument("--unit_attempts", type=int, default=3, help="Number of failed runs after which a unit is given up.")
+    parser.add_argument("--poll_seconds", type=float, default=5.0, help="Wait between two claims when every remaining unit is held by another worker.")
+    parser.add_argument("--output_file", type=str, default='gpt-4-vision-predictions.json', help="Merged predictions file written by --mode merge.")
+    parser.add_argument("--allow_partial", action='store_true', help="Merge the completed units even if others are not done.")
+    args, eval_args = parser.parse_known_args()
+    main(args, eval_args)